@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import openai
+from dotenv import load_dotenv
+
+from cod import MAX_SOURCE_CHARS, MODEL, STEPS, ainitiate_cod, parse_cod_json, pdf_cod_messages
+from cod_json import SchemaError
+from llm_gateway import pooled_aiosession
+
+
+def find_pdfs(source):
+    # A directory is searched recursively, anything else is treated as a glob
+    if os.path.isdir(source):
+        pattern = os.path.join(source, "**", "*.pdf")
+    else:
+        pattern = source
+    return sorted(os.path.abspath(path) for path in glob.glob(pattern, recursive=True))
+
+
+def load_done(output_path):
+    # Documents with a successful line are skipped, failed ones are retried
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by an interrupted run
+            if record.get("status") == "ok":
+                done.add(record["path"])
+    return done
+
+
+PREFETCH = 2  # documents extracted ahead of the LLM stage, per concurrent request
+
+
+def _error(record, e, start):
+    record["status"] = "error"
+    record["error"] = f"{type(e).__name__}: {e}"
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+async def extract(paths, pool, queue, model, steps):
+    # Producer: blocks on the bounded queue, so at most its size of prompts wait in memory.
+    # The prompt context is built in the pool too; only the HTTP calls run on the event loop.
+    loop = asyncio.get_running_loop()
+    for path in paths:
+        start = time.perf_counter()
+        try:
+            # Documents are already spread over the pool, so each one is read by a single process
+            messages = await loop.run_in_executor(pool, pdf_cod_messages, path, model, steps, MAX_SOURCE_CHARS, 1)
+            await queue.put(({"path": path}, start, messages))
+        except Exception as e:
+            await queue.put((_error({"path": path}, e, start), start, None))
+
+
+async def summarize(record, start, messages, model, steps):
+    if messages is None:
+        return record  # extraction failed
+    result = None
+    try:
+        result = await ainitiate_cod(messages, model=model)
+        # Models sometimes write more steps than asked for; trimmed as in cod._single_shot
+        record["summaries"] = parse_cod_json(result)[:steps]
+        record["status"] = "ok"
+    except SchemaError as e:
+        _error(record, e, start)
+        record["raw"] = result
+        return record
+    except Exception as e:
+        return _error(record, e, start)
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+async def run_batch(paths, output_path, concurrency, workers, model, steps=STEPS):
+    # Extraction feeds a queue of concurrency * PREFETCH prompts drained by concurrency LLM
+    # workers, so memory stays bounded however many PDFs there are
+    queue = asyncio.Queue(maxsize=concurrency * PREFETCH)
+    counts = {"ok": 0, "failed": 0}
+
+    async def consume(out):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            record = await summarize(*item, model, steps)
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            counts["ok" if record["status"] == "ok" else "failed"] += 1
+            print(f"[{counts['ok'] + counts['failed']}/{len(paths)}] {record['status']} {record['path']}")
+
+    # Every document's requests reuse the same keep-alive connections
+    async with pooled_aiosession(concurrency):
+        with ProcessPoolExecutor(max_workers=workers) as pool, open(output_path, "a") as out:
+            consumers = [asyncio.create_task(consume(out)) for _ in range(concurrency)]
+            # One extractor per process; each hands its paths over in order
+            producers = [asyncio.create_task(extract(paths[i::workers], pool, queue, model, steps)) for i in range(workers)]
+            try:
+                await asyncio.gather(*producers)
+                for _ in consumers:
+                    await queue.put(None)
+                await asyncio.gather(*consumers)
+            finally:
+                for task in producers + consumers:
+                    task.cancel()
+    return counts["ok"], counts["failed"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run CoD over a directory or glob of PDFs.")
+    parser.add_argument("source", help="directory of PDFs or a glob such as 'filings/*.pdf'")
+    parser.add_argument("-o", "--output", default="cod_results.jsonl", help="JSONL file, appended to and used to resume")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="max LLM requests in flight")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="processes used for PDF extraction")
+    parser.add_argument("-m", "--model", default=MODEL)
+    parser.add_argument("-s", "--steps", type=int, default=STEPS, help="densification steps asked for per document")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+
+    paths = find_pdfs(args.source)
+    done = load_done(args.output)
+    todo = [path for path in paths if path not in done]
+    print(f"{len(paths)} PDFs found, {len(paths) - len(todo)} already done, {len(todo)} to process")
+    if not todo:
+        return
+
+    ok, failed = asyncio.run(run_batch(todo, args.output, args.concurrency, args.workers, args.model, args.steps))
+    print(f"Done: {ok} ok, {failed} failed, results in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+
+import PyPDF2
+from chromadb.config import Settings
+from langchain.document_loaders import PyPDFLoader
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.vectorstores import Chroma
+
+from chunking import DocumentText, TokenChunks
+from cod import COMPLETION_TOKENS, MODEL, cod_messages, parse_cod_json
+from entities import build_entity_index
+from fake_openai import OfflineOpenAI
+from index_store import NUMPY_MAX_CHUNKS
+from llm_cache import chat_completion
+from tracing import span
+from vector_index import NumpyVectorStore
+
+SAMPLE_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "doc", "SSRN-id4573321.pdf")
+STAGES = ["pdf_load", "split", "embed", "index", "retrieve", "ner", "context", "llm", "json_parse"]
+
+
+def _mb(n_bytes):
+    return None if n_bytes is None else round(n_bytes / 1024 ** 2, 1)
+
+
+class StageTimer:
+    # Each stage is a tracing span, so memory is measured per stage the same way as in the apps
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        with span(name) as current:
+            yield
+        self.stages[name] = {
+            "seconds": current.seconds,
+            "peak_alloc_mb": _mb(current.peak_alloc_bytes),
+            "rss_delta_mb": _mb(current.rss_delta_bytes),
+        }
+
+    def skip(self, name, reason):
+        self.stages[name] = {"skipped": reason}
+
+
+def make_synthetic_pdf(source, pages, path):
+    # Repeats the pages of a real paper, so extraction and NER see realistic text
+    reader = PyPDF2.PdfReader(source)
+    writer = PyPDF2.PdfWriter()
+    for i in range(pages):
+        writer.add_page(reader.pages[i % len(reader.pages)])
+    with open(path, "wb") as f:
+        writer.write(f)
+    return path
+
+
+def run_pipeline(path, run_id, workdir, backend):
+    # Same stages as app.py, each timed on its own; persistent caches are bypassed
+    timer = StageTimer()
+
+    with timer.stage("pdf_load"):
+        data = PyPDFLoader(path).load()
+
+    with timer.stage("split"):
+        document = DocumentText.from_documents(data)
+        chunks = TokenChunks(document)
+    texts = chunks.texts()
+
+    embeddings = OpenAIEmbeddings()
+    with timer.stage("embed"):
+        vectors = embeddings.embed_documents(texts)
+
+    if backend == "auto":
+        backend = "numpy" if len(chunks) <= NUMPY_MAX_CHUNKS else "chroma"
+    with timer.stage("index"):
+        if backend == "numpy":
+            vectordb = NumpyVectorStore(embeddings)
+            vectordb.add_vectors(texts, vectors, chunks.metadatas())
+        else:
+            # In-memory collection, but chromadb still writes its HNSW files under persist_directory
+            settings = Settings(chroma_db_impl="duckdb", persist_directory=workdir, anonymized_telemetry=False)
+            vectordb = Chroma(collection_name=f"bench_{run_id}", embedding_function=embeddings, client_settings=settings)
+            vectordb._collection.add(
+                ids=[str(i) for i in range(len(texts))],
+                embeddings=vectors,
+                documents=texts,
+                metadatas=chunks.metadatas(),
+            )
+
+    with timer.stage("retrieve"):
+        retrieved_docs = vectordb.as_retriever().get_relevant_documents("Article Summary")
+    if backend == "chroma":
+        vectordb.delete_collection()
+
+    article_content = " ".join([doc.page_content for doc in retrieved_docs])
+    try:
+        with timer.stage("ner"):
+            build_entity_index(article_content)
+    except OSError as e:
+        timer.skip("ner", f"spaCy model not available: {e}")
+
+    article_text = document.text
+    with timer.stage("context"):
+        messages = cod_messages(article_text, MODEL)
+
+    with timer.stage("llm"):
+        response = chat_completion(cache=False, model=MODEL, messages=messages, max_tokens=COMPLETION_TOKENS)
+
+    with timer.stage("json_parse"):
+        parse_cod_json(response["choices"][0]["message"]["content"])
+
+    return {"pages": len(data), "chunks": len(chunks), "backend": backend, "stages": timer.stages}
+
+
+def summarize_runs(runs):
+    # Median time per stage over the repeats, highest memory seen
+    stages = {}
+    for name in STAGES:
+        measured = [run["stages"][name] for run in runs if "seconds" in run["stages"].get(name, {})]
+        if not measured:
+            stages[name] = runs[-1]["stages"].get(name, {"skipped": "not run"})
+            continue
+        stages[name] = {
+            "seconds": round(statistics.median(m["seconds"] for m in measured), 4),
+            "peak_alloc_mb": max(m["peak_alloc_mb"] for m in measured),
+            "rss_delta_mb": max(m["rss_delta_mb"] or 0 for m in measured),
+        }
+    return {"pages": runs[-1]["pages"], "chunks": runs[-1]["chunks"], "backend": runs[-1]["backend"], "stages": stages}
+
+
+def compare(report, baseline, tolerance, min_delta):
+    # A stage regresses when it is both tolerance-fraction and min_delta seconds slower
+    regressions = []
+    for name, document in report["documents"].items():
+        previous = baseline.get("documents", {}).get(name)
+        if previous is None:
+            continue
+        for stage, result in document["stages"].items():
+            before = previous["stages"].get(stage, {})
+            if "seconds" not in result or "seconds" not in before:
+                continue
+            delta = result["seconds"] - before["seconds"]
+            if delta > min_delta and delta > before["seconds"] * tolerance:
+                regressions.append(f"{name} {stage}: {before['seconds']}s -> {result['seconds']}s")
+            if "peak_alloc_mb" in before and result["peak_alloc_mb"] > max(before["peak_alloc_mb"], 1) * (1 + tolerance):
+                regressions.append(
+                    f"{name} {stage}: {before['peak_alloc_mb']}MB -> {result['peak_alloc_mb']}MB peak allocated"
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time each CoD pipeline stage without network access. Chat and embedding calls are "
+                    "answered by deterministic fakes or replayed from a cassette. tiktoken encodings must "
+                    "already be in TIKTOKEN_CACHE_DIR on machines without network."
+    )
+    parser.add_argument("pdfs", nargs="*", default=[SAMPLE_PDF], help="PDFs to benchmark (default: the sample paper)")
+    parser.add_argument("--synthetic-pages", type=int, nargs="*", default=[200],
+                        help="also benchmark synthetic PDFs of these page counts built from the sample")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cassette", help="replay chat/embedding responses from this JSON file")
+    parser.add_argument("--record", action="store_true", help="call the real API and write responses to --cassette")
+    parser.add_argument("--vector-backend", choices=["auto", "numpy", "chroma"], default="auto",
+                        help=f"auto picks numpy up to {NUMPY_MAX_CHUNKS} chunks, like the app")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds added to every fake API call")
+    parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="previous report; exit 1 if any stage regressed")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown")
+    parser.add_argument("--min-delta", type=float, default=0.05, help="ignore slowdowns below this many seconds")
+    args = parser.parse_args(argv)
+    if args.record and not args.cassette:
+        parser.error("--record needs --cassette")
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "model": MODEL,
+        "repeat": args.repeat,
+        "documents": {},
+    }
+    # Per-stage allocation peaks; slows every stage down about equally, so runs stay comparable
+    tracemalloc.start()
+    with tempfile.TemporaryDirectory() as tmp, OfflineOpenAI(args.cassette, args.record, args.llm_latency) as offline:
+        documents = {os.path.basename(path): path for path in args.pdfs}
+        for pages in args.synthetic_pages:
+            documents[f"synthetic-{pages}p"] = make_synthetic_pdf(SAMPLE_PDF, pages, os.path.join(tmp, f"{pages}.pdf"))
+
+        for run_id, (name, path) in enumerate(documents.items()):
+            runs = [run_pipeline(path, f"{run_id}_{i}", tmp, args.vector_backend) for i in range(args.repeat)]
+            report["documents"][name] = summarize_runs(runs)
+            print(f"{name}: " + ", ".join(
+                f"{stage} {result['seconds']}s" for stage, result in report["documents"][name]["stages"].items()
+                if "seconds" in result
+            ), file=sys.stderr)
+        report["api_calls"] = offline.calls
+
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(payload + "\n")
+    else:
+        print(payload)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance, args.min_delta)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import numpy as np
+
+from context import token_windows, tokenize
+from tracing import span
+
+# The whole document is tokenized once. Chunks are overlapping token windows kept as
+# character offsets into the one document string, and a chunk's text is only sliced out
+# when something asks for it. This replaces TokenTextSplitter.split_documents, which
+# tokenized page by page and copied every overlapping chunk into a new Document.
+
+CHUNK_TOKENS = 1000
+CHUNK_OVERLAP = 150
+TOKEN_MODEL = "text-embedding-ada-002"  # chunks are sized for the embedding model
+PAGE_SEPARATOR = " "
+
+
+class DocumentText:
+    # The pages of a document joined into one string, and where each page starts in it
+
+    def __init__(self, pages, source=None, separator=PAGE_SEPARATOR):
+        pages = list(pages)
+        self.text = separator.join(pages)
+        self.source = source
+        lengths = np.fromiter(map(len, pages), dtype=np.int64, count=len(pages)) + len(separator)
+        self.page_starts = np.cumsum(lengths) - lengths
+
+    @classmethod
+    def from_documents(cls, documents):
+        # From langchain page Documents, e.g. PyPDFLoader's
+        source = documents[0].metadata.get("source") if documents else None
+        return cls((doc.page_content for doc in documents), source)
+
+    def __len__(self):
+        return len(self.text)
+
+    @property
+    def n_pages(self):
+        return len(self.page_starts)
+
+    def page_at(self, offsets):
+        # Page number of each character offset
+        return np.searchsorted(self.page_starts, offsets, side="right") - 1
+
+
+class TokenChunks:
+    # Overlapping windows of chunk_tokens tokens, chunk_overlap of them shared with the
+    # previous window. Each chunk is a (start, end) span of document.text.
+
+    def __init__(self, document, chunk_tokens=CHUNK_TOKENS, chunk_overlap=CHUNK_OVERLAP, model=TOKEN_MODEL):
+        if not 0 <= chunk_overlap < chunk_tokens:
+            raise ValueError("chunk_overlap must be smaller than chunk_tokens")
+        self.document = document
+        with span("split", chars=len(document)) as current:
+            # Cached: selecting the prompt context from the same text reuses this tokenization
+            self.tokens, offsets = tokenize(document.text, model)
+            self.first_token, self.last_token = token_windows(len(self.tokens), chunk_tokens, chunk_overlap)
+            offsets = np.append(offsets, len(document))
+            self.starts, self.ends = offsets[self.first_token], offsets[self.last_token]
+            self.pages = document.page_at(self.starts)
+            self.last_pages = document.page_at(np.maximum(self.ends - 1, self.starts))
+            current.attrs["chunks"] = len(self)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        return self.document.text[self.starts[i]:self.ends[i]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def n_tokens(self, i):
+        return int(self.last_token[i] - self.first_token[i])
+
+    def metadata(self, i):
+        return {
+            "source": self.document.source,
+            "page": int(self.pages[i]),
+            "last_page": int(self.last_pages[i]),
+            "start": int(self.starts[i]),
+            "end": int(self.ends[i]),
+        }
+
+    def texts(self):
+        return list(self)
+
+    def metadatas(self):
+        return [self.metadata(i) for i in range(len(self))]
+
+    def documents(self):
+        # langchain Documents, for vector stores that want them
+        from langchain.schema import Document
+        return [Document(page_content=self[i], metadata=self.metadata(i)) for i in range(len(self))]
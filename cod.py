@@ -0,0 +1,391 @@
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cod_json import StepStreamParser, parse_cod_json
+from densify import ANSWER_ENDED, MAX_STEPS, StopController
+from context import CONTEXT_TOKENS, count_tokens, document_tokens, prompt_budget, select_context, token_chunks
+from entities import build_entity_index
+from llm_cache import achat_completion, chat_completion, stream_chat_completion
+from pdf_text import extract_text
+from tracing import span
+
+MODEL = "gpt-3.5-turbo-16k"
+MAX_SOURCE_CHARS = 400000  # extraction stops here; the prompt context is chosen by tokens
+COMPLETION_TOKENS = 1000  # You can adjust this based on your needs
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+# single_shot: one call that returns all steps as JSON
+# iterative: one call per step, with missing entities picked by spaCy and only the passages
+# that mention them; stops early (see densify)
+# hierarchical: sections summarized concurrently (map), then single_shot over the summaries (reduce)
+MODES = ("single_shot", "iterative", "hierarchical")
+DEFAULT_MODELS = {"single_shot": MODEL, "iterative": "gpt-4", "hierarchical": MODEL}
+STEPS = 5  # densification rounds; the iterative mode may stop before
+
+# Each iterative round sees only the text around its missing entities, not the article
+RETRIEVE_K = 4  # passages retrieved per missing entity; the first one that mentions it is used
+PASSAGE_CHARS = 800  # characters kept around that mention
+PASSAGE_SEPARATOR = "\n---\n"
+
+SECTION_TOKENS = 6000  # article tokens per map call
+SECTION_SUMMARY_TOKENS = 400
+FAN_OUT = 8  # map calls in flight at once
+
+SECTION_PROMPT = """Section {index} of {total} of a long article:
+{section}
+
+Summarize this section in at most {words} words. Keep every named entity, number and date that matters to the article's main story. Leave out examples, citations and boilerplate."""
+
+COD_PROMPT = """Article: {context}
+            You will generate increasingly concise, entity-dense summaries of the above article.
+
+            Repeat the following 2 steps {steps} times.
+
+            Step 1. Identify 1-3 informative entities (";" delimited) from the article which are missing from the previously generated summary.
+            Step 2. Write a new, denser summary of identical length which covers every entity and detail from the previous summary plus the missing entities.
+
+            A missing entity is:
+            - relevant to the main story,
+            - specific yet concise (5 words or fewer),
+            - novel (not in the previous summary),
+            - faithful (present in the article),
+            - anywhere (can be located anywhere in the article).
+
+            Guidelines:
+
+            - The first summary should be long (4-5 sentences, ~80 words) yet highly non-specific, containing little information beyond the entities marked as missing. Use overly verbose language and fillers (e.g., "this article discusses") to reach ~80 words.
+            - Make every word count: rewrite the previous summary to improve flow and make space for additional entities.
+            - Make space with fusion, compression, and removal of uninformative phrases like "the article discusses".
+            - The summaries should become highly dense and concise yet self-contained, i.e., easily understood without the article.
+            - Missing entities can appear anywhere in the new summary.
+            - Never drop entities from the previous summary. If space cannot be made, add fewer new entities.
+
+            Remember, use the exact same number of words for each summary.
+
+            Answer in JSON. The JSON should be a list (length {steps}) of dictionaries whose keys are "Missing_Entities" and "Denser_Summary"."""
+
+
+def read_pdf(pdf_file, max_chars=None, max_tokens=None):
+    # Pages past max_chars (or max_tokens) are never parsed
+    return extract_text(pdf_file, max_chars=max_chars, max_tokens=max_tokens)
+
+
+def read_pdf_path(pdf_path, max_chars=None, workers=None):
+    # Large files are extracted across worker processes
+    return extract_text(pdf_path, max_chars=max_chars, workers=workers)
+
+
+def pdf_cod_messages(pdf_path, model=MODEL, steps=STEPS, max_chars=MAX_SOURCE_CHARS, workers=None):
+    # Extraction, tokenizing and NER in one call, so a worker process can do all of the
+    # CPU work and only the (budget-sized) messages come back
+    return cod_messages(read_pdf_path(pdf_path, max_chars, workers), model, steps=steps)
+
+
+def build_article_context(article_text, model=MODEL, context_tokens=CONTEXT_TOKENS, retriever=None,
+                          entity_index=None):
+    # Never more than fits next to the instructions and the answer
+    budget = reduce_budget(model, context_tokens)
+    return select_context(article_text, model, budget, entity_index=entity_index, retriever=retriever)
+
+
+def reduce_budget(model=MODEL, context_tokens=CONTEXT_TOKENS):
+    instructions = count_tokens(SYSTEM_PROMPT + COD_PROMPT.format(context="", steps=STEPS), model)
+    return min(context_tokens, prompt_budget(model, instructions, COMPLETION_TOKENS))
+
+
+def fits_context(article_text, model=MODEL, context_tokens=CONTEXT_TOKENS):
+    # True when the article is sent whole, so there is nothing to rank
+    return document_tokens(article_text, model) <= reduce_budget(model, context_tokens)
+
+
+def hierarchy_tokens(model=MODEL):
+    # The most article tokens that can be sent whole, with the full context window
+    instructions = count_tokens(SYSTEM_PROMPT + COD_PROMPT.format(context="", steps=STEPS), model)
+    return prompt_budget(model, instructions, COMPLETION_TOKENS)
+
+
+def needs_hierarchy(article_text, model=MODEL):
+    # True when the article cannot be sent whole, even with the full context window
+    return document_tokens(article_text, model) > hierarchy_tokens(model)
+
+
+def cod_messages(article_text, model=MODEL, context_tokens=CONTEXT_TOKENS, retriever=None, steps=STEPS,
+                 entity_index=None):
+    # Prepare the prompt
+    with span("context", budget=context_tokens):
+        context = build_article_context(article_text, model, context_tokens, retriever, entity_index)
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": COD_PROMPT.format(context=context, steps=steps)},
+    ]
+
+
+def response_content(response):
+    # Check if 'choices' key exists
+    if 'choices' in response:
+        # Check if 'message' and 'content' keys exist in response['choices'][0]
+        if 'message' in response['choices'][0] and 'content' in response['choices'][0]['message']:
+            return response['choices'][0]['message']['content'].strip()
+        else:
+            return "Keys 'message' and/or 'content' not found in response['choices'][0]."
+    else:
+        return "Key 'choices' not found in response."
+
+
+def initiate_cod(article_text, model=MODEL, steps=STEPS):
+    # API errors propagate once the gateway has given up retrying, so they are never shown as a summary
+    response = chat_completion(
+        model=model,
+        messages=cod_messages(article_text, model, steps=steps),
+        max_tokens=COMPLETION_TOKENS
+    )
+    return response_content(response)
+
+
+async def ainitiate_cod(messages, model=MODEL):
+    # Takes cod_messages' output: building the context tokenizes and parses the whole
+    # article, which would stall the event loop, so callers do it elsewhere (see batch.py)
+    response = await achat_completion(
+        model=model,
+        messages=messages,
+        max_tokens=COMPLETION_TOKENS
+    )
+    return response_content(response)
+
+
+def stream_cod(article_text, model=MODEL, steps=STEPS, parser=None):
+    # Yields each step as soon as the model has finished writing it. Pass a parser to get
+    # at the raw answer afterwards; a cut-off last step is recovered when the stream ends.
+    parser = parser or StepStreamParser()
+    stream = stream_chat_completion(
+        model=model,
+        messages=cod_messages(article_text, model, steps=steps),
+        max_tokens=COMPLETION_TOKENS
+    )
+    for delta in stream:
+        yield from parser.feed(delta)
+    with span("json_parse"):
+        yield from parser.close()
+
+
+def identify_missing_entities(entity_index, included_entities):
+    # The article is parsed once per document, each round is a set lookup
+    missing_entities = entity_index.missing(included_entities, limit=3)  # Limit to 1-3 entities
+    return missing_entities
+
+
+def mention_window(text, entity, chars=PASSAGE_CHARS):
+    # About chars characters centred on the first mention of entity, cut at spaces
+    position = text.lower().find(entity.lower())
+    if position < 0:
+        return None
+    start = max(0, position + len(entity) // 2 - chars // 2)
+    end = min(len(text), start + chars)
+    if start > 0:
+        start = text.find(" ", start, position) + 1 or start
+    if end < len(text):
+        cut = text.rfind(" ", position + len(entity), end)
+        end = cut if cut > 0 else end
+    return text[start:end].strip()
+
+
+def _search_batch(retriever, queries, k):
+    # One embedding request for all queries where the vector store allows it
+    store = getattr(retriever, "vectorstore", None)
+    if store is None:
+        return [retriever.get_relevant_documents(query) for query in queries]
+    if hasattr(store, "batch_search"):
+        return store.batch_search(queries, k)
+    vectors = store.embeddings.embed_documents(list(queries))
+    return [store.similarity_search_by_vector(vector, k) for vector in vectors]
+
+
+def entity_passages(missing_entities, retriever, article_content, k=RETRIEVE_K):
+    # A passage around a mention of each missing entity. Retrieved chunks are searched
+    # first; the text the entities were picked from always mentions them.
+    if not missing_entities:
+        return []
+    with span("retrieve", entities=len(missing_entities)) as current:
+        candidates = _search_batch(retriever, missing_entities, k) if retriever is not None else \
+            [[] for _ in missing_entities]
+        passages = []
+        for entity, docs in zip(missing_entities, candidates):
+            for text in [doc.page_content for doc in docs] + [article_content]:
+                window = mention_window(text, entity)
+                if window:
+                    if window not in passages:
+                        passages.append(window)
+                    break
+        current.attrs["passages"] = len(passages)
+    return passages
+
+
+def generate_new_summary(current_summary, missing_entities, model, passages=()):
+    # Construct the prompt; the passages ground the new entities
+    content = f"Current Summary: {current_summary}\nMissing Entities: {'; '.join(missing_entities)}\n"
+    if passages:
+        content = f"Passages:\n{PASSAGE_SEPARATOR.join(passages)}\n\n{content}Generate a new summary that includes these entities, using only facts from the passages and the current summary, while maintaining the same word count."
+    else:
+        content += "Generate a new summary that includes these entities while maintaining the same word count."
+    prompt = {
+        "role": "user",
+        "content": content
+    }
+    return chat_completion(
+        model=model,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            prompt
+        ]
+    )
+
+
+def summarize_section(section, index, total, model):
+    prompt = SECTION_PROMPT.format(index=index, total=total, section=section, words=SECTION_SUMMARY_TOKENS * 3 // 5)
+    return chat_completion(
+        model=model,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=SECTION_SUMMARY_TOKENS
+    )
+
+
+class _Usage:
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def add(self, response):
+        usage = response.get("usage") or {}
+        self.calls += 1
+        self.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.completion_tokens += usage.get("completion_tokens", 0)
+
+
+def _single_shot(article_text, model, usage, context_tokens, retriever, steps, entity_index=None):
+    messages = cod_messages(article_text, model, context_tokens, retriever, steps, entity_index)
+    response = chat_completion(model=model, messages=messages, max_tokens=COMPLETION_TOKENS)
+    usage.add(response)
+    with span("json_parse"):
+        return parse_cod_json(response["choices"][0]["message"]["content"])[:steps]
+
+
+def _iterative(article_text, model, usage, retriever, controller, entity_index=None):
+    if retriever is not None:
+        # Retrieve relevant chunks from the article
+        with span("retrieve"):
+            retrieved_docs = retriever.get_relevant_documents("Article Summary")
+        article_content = " ".join([doc.page_content for doc in retrieved_docs])
+        entity_index = build_entity_index(article_content)
+    else:
+        # No prompt ever holds the article, only passages around each round's entities,
+        # so the entities are picked from all of it
+        article_content = article_text
+        if entity_index is None:
+            entity_index = build_entity_index(article_content)
+
+    steps = []
+    current_summary = ""
+    included_entities = []
+    while True:
+        # Identify missing entities from the article
+        missing_entities = identify_missing_entities(entity_index, included_entities)
+        if controller.should_stop(missing_entities, usage.prompt_tokens + usage.completion_tokens):
+            break
+
+        # Generate a new, denser summary from the passages that mention the new entities
+        start = time.perf_counter()
+        passages = entity_passages(missing_entities, retriever, article_content)
+        response = generate_new_summary(current_summary, missing_entities, model, passages)
+        usage.add(response)
+        current_summary = response["choices"][0]["message"]["content"].strip()
+        included_entities.extend(missing_entities)
+
+        # Progress is measured on the entities the summary actually mentions
+        density = len(entity_index.found_in(current_summary)) / max(count_tokens(current_summary, model), 1)
+        tokens = (response.get("usage") or {}).get("total_tokens", 0)
+        controller.record(density, time.perf_counter() - start, tokens)
+
+        steps.append({
+            "Missing_Entities": missing_entities,
+            "Denser_Summary": current_summary
+        })
+    return steps
+
+
+def _map_sections(sections, model, usage, fan_out):
+    # The gateway keeps concurrent calls inside the rate limits; spans follow the caller's trace
+    with ThreadPoolExecutor(max_workers=fan_out) as pool:
+        futures = [
+            pool.submit(contextvars.copy_context().run, summarize_section, section, i + 1, len(sections), model)
+            for i, section in enumerate(sections)
+        ]
+        responses = [future.result() for future in futures]
+    for response in responses:
+        usage.add(response)
+    return [response_content(response) for response in responses]
+
+
+def _hierarchical(article_text, model, usage, context_tokens, fan_out, steps):
+    # Wall time grows with sections / fan_out per level, not with pages
+    instructions = count_tokens(SYSTEM_PROMPT + SECTION_PROMPT, model)
+    section_tokens = min(SECTION_TOKENS, prompt_budget(model, instructions, SECTION_SUMMARY_TOKENS))
+    budget = reduce_budget(model, context_tokens)
+    text = article_text
+    level = 0
+    while True:
+        chunks = token_chunks(text, model, section_tokens)
+        n_tokens = sum(chunk.n_tokens for chunk in chunks)
+        if n_tokens <= budget:
+            break
+        with span("map", level=level, sections=len(chunks), fan_out=fan_out):
+            summaries = _map_sections([text[chunk.start:chunk.end] for chunk in chunks], model, usage, fan_out)
+        merged = "\n\n".join(summaries)
+        if len(merged) >= len(text):
+            break  # summaries no longer shrink; select_context trims the rest
+        text = merged
+        level += 1
+    with span("reduce", levels=level):
+        # The merged summaries are not the retriever's document, so nothing is passed for them
+        return _single_shot(text, model, usage, context_tokens, None, steps)
+
+
+def run_cod(article_text, mode="single_shot", model=None, retriever=None, context_tokens=CONTEXT_TOKENS,
+            fan_out=FAN_OUT, steps=STEPS, max_seconds=None, max_tokens=None, entity_index=None):
+    # All modes return the same schema; failures (API errors, unparsable JSON) raise.
+    # steps is the most rounds to run; max_seconds and max_tokens only bound the iterative
+    # mode, the others make a single CoD call. A retriever built from article_text grounds
+    # the iterative rounds and ranks single_shot's context by its stored chunk vectors.
+    # An entity_index of article_text (e.g. a cached one) saves parsing the article again.
+    if mode not in MODES:
+        raise ValueError(f"Unknown CoD mode {mode!r}, expected one of {MODES}")
+    if steps < 1:
+        raise ValueError("steps must be at least 1")
+    model = model or DEFAULT_MODELS[mode]
+    usage = _Usage()
+    controller = StopController(steps, max_seconds, max_tokens)
+    with span("cod", mode=mode, model=model, steps=steps) as current:
+        if mode == "single_shot":
+            summaries = _single_shot(article_text, model, usage, context_tokens, retriever, steps, entity_index)
+        elif mode == "hierarchical":
+            summaries = _hierarchical(article_text, model, usage, context_tokens, fan_out, steps)
+        else:
+            summaries = _iterative(article_text, model, usage, retriever, controller, entity_index)
+        if controller.stop_reason is None:
+            controller.stop_reason = MAX_STEPS if len(summaries) >= steps else ANSWER_ENDED
+        current.attrs["stop_reason"] = controller.stop_reason
+    return {
+        "mode": mode,
+        "model": model,
+        "steps": summaries,
+        "stop_reason": controller.stop_reason,
+        "latency_s": round(time.perf_counter() - controller.start, 3),
+        "calls": usage.calls,
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.prompt_tokens + usage.completion_tokens,
+    }
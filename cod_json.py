@@ -0,0 +1,244 @@
+import json
+import re
+
+# The CoD answer is a list of {"Missing_Entities": ..., "Denser_Summary": ...}. Models get
+# it slightly wrong often enough (fences, trailing commas, a cut-off last step) that a
+# strict json.loads throws away whole runs, so everything here repairs what it can.
+# Raw newlines and tabs inside strings are the most common fault; strict=False takes them.
+
+_FENCE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def _key(name):
+    # "Missing_Entities", "missing entities" and "MissingEntities" are the same key
+    return re.sub(r"[^a-z]", "", str(name).lower())
+
+
+def split_entities(value):
+    # The model answers with a ";" delimited string, the iterative mode with a list
+    if isinstance(value, str):
+        return [entity.strip() for entity in value.split(";") if entity.strip()]
+    return [str(entity).strip() for entity in value]
+
+
+def is_step(obj):
+    return isinstance(obj, dict) and "densersummary" in {_key(k) for k in obj}
+
+
+def normalize_step(obj):
+    if not is_step(obj):
+        raise SchemaError(f"not a CoD step: {obj!r:.80}")
+    fields = {_key(k): v for k, v in obj.items()}
+    summary = fields["densersummary"]
+    if not isinstance(summary, str) or not summary.strip():
+        raise SchemaError("Denser_Summary must be a non-empty string")
+    entities = fields.get("missingentities", [])
+    if entities is None:
+        entities = []
+    if not isinstance(entities, (str, list)):
+        raise SchemaError("Missing_Entities must be a string or a list")
+    return {"Missing_Entities": split_entities(entities), "Denser_Summary": summary.strip()}
+
+
+def repair_json(text):
+    # Drops fences, prose around the JSON and trailing commas, adds missing commas between
+    # objects, and closes whatever a cut-off answer left open. A string cut off mid-way is
+    # dropped with its key rather than kept half written. Objects that follow each other
+    # with no enclosing list (one per line, say) are collected into one.
+    text = _FENCE.sub("", text)
+    starts = [i for i in (text.find("["), text.find("{")) if i >= 0]
+    if not starts:
+        raise SchemaError("no JSON value in the answer")
+    text = text[min(starts):]
+
+    out = []
+    stack = []
+    in_string = escape = False
+    string_start = None
+    several = False
+    for i, char in enumerate(text):
+        if in_string:
+            out.append(char)
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            if out and out[-1] in '}"' or out and out[-1] == "]" and stack:
+                _append_comma(out)
+            in_string = True
+            string_start = len(out)
+            out.append(char)
+        elif char in "{[":
+            if out and out[-1] in '}]"':
+                _append_comma(out)
+            stack.append(char)
+            out.append(char)
+        elif char in "}]":
+            if not stack:
+                break  # the JSON is over; anything after it is prose
+            _drop_trailing_comma(out)
+            opener = stack.pop()
+            out.append(_CLOSERS[opener])
+            if not stack:
+                if opener == "{" and _next_value(text, i + 1) == "{":
+                    several = True
+                    continue
+                break
+        elif char.isspace():
+            continue
+        else:
+            out.append(char)
+
+    if in_string:
+        del out[string_start:]
+    while True:
+        _drop_trailing_comma(out)
+        if out and out[-1] == ":":
+            out.pop()
+            # and the key that went with it
+            while out and out[-1] != '"':
+                out.pop()
+            if out:
+                out.pop()
+            while out and out[-1] != '"':
+                out.pop()
+            if out:
+                out.pop()
+            continue
+        break
+    out.extend(_CLOSERS[opener] for opener in reversed(stack))
+    if several:
+        _drop_trailing_comma(out)
+        return "[" + "".join(out) + "]"
+    return "".join(out)
+
+
+def _next_value(text, start):
+    # The first character after start that is not whitespace or a comma
+    for char in text[start:]:
+        if not char.isspace() and char != ",":
+            return char
+    return None
+
+
+def _append_comma(out):
+    # Only between two values, never after a key
+    if out[-1] != ",":
+        out.append(",")
+
+
+def _drop_trailing_comma(out):
+    while out and out[-1] == ",":
+        out.pop()
+
+
+def _as_steps(value):
+    if isinstance(value, list):
+        return value
+    if is_step(value):
+        return [value]
+    if isinstance(value, dict):
+        # {"summaries": [...]} and similar wrappers
+        for item in value.values():
+            if isinstance(item, list):
+                return item
+    raise SchemaError("expected a list of CoD steps")
+
+
+def parse_cod_json(text):
+    # Strict parse first; the repaired text only when that fails. Steps that do not match
+    # the schema are skipped, but at least one has to.
+    try:
+        value = json.loads(_FENCE.sub("", text.strip()), strict=False)
+    except json.JSONDecodeError:
+        try:
+            value = json.loads(repair_json(text), strict=False)
+        except json.JSONDecodeError as e:
+            raise SchemaError(f"unrepairable JSON: {e}") from e
+    steps = []
+    for item in _as_steps(value):
+        try:
+            steps.append(normalize_step(item))
+        except SchemaError:
+            continue
+    if not steps:
+        raise SchemaError("no valid CoD steps in the answer")
+    return steps
+
+
+class StepStreamParser:
+    # Fed the answer as it streams; returns each step as soon as its object closes
+
+    def __init__(self):
+        self.text = ""
+        self.steps = []
+        self.errors = []
+        self._pos = 0
+        self._objects = []  # start offsets of the open objects
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, delta):
+        self.text += delta
+        found = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._objects.append(i)
+            elif char == "}" and self._objects:
+                step = self._step(text[self._objects.pop():i + 1])
+                if step is not None:
+                    found.append(step)
+        self._pos = len(text)
+        self.steps.extend(found)
+        return found
+
+    def _step(self, chunk):
+        try:
+            obj = json.loads(chunk, strict=False)
+        except json.JSONDecodeError:
+            try:
+                obj = json.loads(repair_json(chunk), strict=False)
+            except (json.JSONDecodeError, SchemaError) as e:
+                self.errors.append(str(e))
+                return None
+        if not is_step(obj):
+            return None  # a wrapper around steps that were already returned
+        try:
+            return normalize_step(obj)
+        except SchemaError as e:
+            self.errors.append(str(e))
+            return None
+
+    def close(self):
+        # The answer is over: recover a last step that was cut off after its summary
+        found = []
+        for start in reversed(self._objects):
+            step = self._step(self.text[start:])
+            if step is not None:
+                found.append(step)
+                break
+        self._objects = []
+        self.steps.extend(found)
+        if not self.steps:
+            raise SchemaError("no valid CoD steps in the answer" + (f": {self.errors[-1]}" if self.errors else ""))
+        return found
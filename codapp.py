@@ -1,83 +1,20 @@
-import openai
-import PyPDF2
 from dotenv import load_dotenv
-import os
 import streamlit as st
-import io
 import json  # Add this line
 
+from cod import MAX_SOURCE_CHARS, STEPS, hierarchy_tokens, needs_hierarchy, run_cod, stream_cod
+from cod_json import SchemaError, StepStreamParser
+from metrics import score_result
+from streamlit_cache import file_hash, load_text
+from tracing import render_sidebar, start_trace
+
 
 
 # Load .env file
 load_dotenv()
 
-# Get API key from .env
-openai.api_key = os.getenv('OPENAI_API_KEY')
-
-
-def read_pdf(pdf_file):
-    pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_file))
-    text = ''
-    for page in pdf_reader.pages:
-        text += page.extract_text()
-    return text
-
-def initiate_cod(article_text):
-    # Prepare the prompt
-    context = article_text[:30000]  # Adjust this number based on your needs
-    prompt = f"""Article: {{context}}
-            You will generate increasingly concise, entity-dense summaries of the above article.
-
-            Repeat the following 2 steps 5 times.
-
-            Step 1. Identify 1-3 informative entities (";" delimited) from the article which are missing from the previously generated summary.
-            Step 2. Write a new, denser summary of identical length which covers every entity and detail from the previous summary plus the missing entities.
-
-            A missing entity is:
-            - relevant to the main story,
-            - specific yet concise (5 words or fewer),
-            - novel (not in the previous summary),
-            - faithful (present in the article),
-            - anywhere (can be located anywhere in the article).
-
-            Guidelines:
-
-            - The first summary should be long (4-5 sentences, ~80 words) yet highly non-specific, containing little information beyond the entities marked as missing. Use overly verbose language and fillers (e.g., "this article discusses") to reach ~80 words.
-            - Make every word count: rewrite the previous summary to improve flow and make space for additional entities.
-            - Make space with fusion, compression, and removal of uninformative phrases like "the article discusses".
-            - The summaries should become highly dense and concise yet self-contained, i.e., easily understood without the article.
-            - Missing entities can appear anywhere in the new summary.
-            - Never drop entities from the previous summary. If space cannot be made, add fewer new entities.
-
-            Remember, use the exact same number of words for each summary.
-
-            Answer in JSON. The JSON should be a list (length 5) of dictionaries whose keys are "Missing_Entities" and "Denser_Summary".""".format(context=context)
-
-    try:
-        # Call OpenAI API
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo-16k",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt},
-            ],
-            max_tokens=1000  # You can adjust this based on your needs
-        )
-
-        # Check if 'choices' key exists
-        if 'choices' in response:
-            # Check if 'message' and 'content' keys exist in response['choices'][0]
-            if 'message' in response['choices'][0] and 'content' in response['choices'][0]['message']:
-                return response['choices'][0]['message']['content'].strip()
-            else:
-                return "Keys 'message' and/or 'content' not found in response['choices'][0]."
-        else:
-            return "Key 'choices' not found in response."
+# openai picks up OPENAI_API_KEY from .env when the first request imports it
 
-    except KeyError as e:
-        return f"KeyError: {e}"
-    except Exception as e:
-        return f"An unexpected error occurred: {e}"
 
 # Streamlit code
 st.title('CoD Initiator')
@@ -96,51 +33,86 @@ Summaries generated using the CoD approach are more abstractive, exhibit greater
 
 uploaded_file = st.file_uploader("Choose a PDF file", type="pdf")
 
-if st.button('Initiate the CoD'):
-    # Create a progress bar
-    progress_bar = st.progress(0)
-
-    # Update the progress bar to indicate that the process has started
-    progress_bar.progress(10)
-
-    article_text = read_pdf(uploaded_file.read())
-    result = initiate_cod(article_text)
-
-    # Update the progress bar to indicate that the process is halfway done
-    progress_bar.progress(50)
-
-    # Add the following code snippet where you display the summaries
-    try:
-        result_json = json.loads(result)
-        # Initialize human preference percentages based on the summary step (i+1)
-        human_pref = {1: 8.3, 2: 30.8, 3: 23.0, 4: 22.5, 5: 15.5}
-
-        # Iterate over the result and display each item in a formatted way
-        for i, item in enumerate(result_json):
-            human_pref_percentage = human_pref[i+1]  # Retrieve the percentage for the current step
-            color = "yellow"  # Initialize to yellow
-
-            # Assign color based on the human preference percentage
-            if human_pref_percentage == max(human_pref.values()):
-                color = "green"
-            elif human_pref_percentage == min(human_pref.values()):
-                color = "red"
-
-            st.markdown(f"<span style='color:{color}'>**Summary {i+1}**</span>", unsafe_allow_html=True)
-            st.markdown(f"<span style='color:{color}'>This result will most likely be preferred by {human_pref_percentage}% of humans</span>", unsafe_allow_html=True)
-            st.markdown(f"**Missing Entities:** {item['Missing_Entities']}")
-            st.markdown(f"**Denser Summary:** {item['Denser_Summary']}")
-            st.markdown("---")
+def show_step(i, item, metrics=None, best=False):
+    # Green for the chosen step, red for steps that break the length or entity rules
+    color = "green" if best else "red" if metrics and not metrics["valid"] else "yellow"
+    st.markdown(f"<span style='color:{color}'>**Summary {i+1}**{' (best)' if best else ''}</span>", unsafe_allow_html=True)
+    if metrics:
+        retention = "n/a" if metrics["retention"] is None else f"{metrics['retention']:.0%}"
+        novelty = "n/a" if metrics["novelty"] is None else f"{metrics['novelty']:.0%}"
+        st.caption(
+            f"{metrics['words']} words ({metrics['word_drift']:+.0%} vs. step 1), "
+            f"{metrics['entity_density']:.3f} entities/token, {retention} of previous entities kept, "
+            f"{novelty} novel bigrams"
+        )
+    st.markdown(f"**Missing Entities:** {item['Missing_Entities']}")
+    st.markdown(f"**Denser Summary:** {item['Denser_Summary']}")
+    st.markdown("---")
+
+
+if st.button('Initiate the CoD') and uploaded_file is not None:
+    import openai  # for its error types; the request below imports it anyway
+
+    with start_trace("codapp") as trace:
+        # Create a progress bar
+        progress_bar = st.progress(0)
+
+        # Update the progress bar to indicate that the process has started
+        progress_bar.progress(10)
+
+        # Extracted once per file; reruns and re-clicks reuse the text. Extraction stops as
+        # soon as the article is known to be too long to send whole.
+        pdf_bytes = uploaded_file.getvalue()
+        pdf_hash = file_hash(pdf_bytes)
+        article_text = load_text(pdf_hash, pdf_bytes, MAX_SOURCE_CHARS, hierarchy_tokens() + 1)
+        progress_bar.progress(30)
+
+        parser = StepStreamParser()
+        steps = []
+        slots = []
+        try:
+            if needs_hierarchy(article_text):
+                # Too long to send whole: every page is read (in parallel), then sections are
+                # summarized in parallel and densified
+                article_text = load_text(pdf_hash, pdf_bytes, None)
+                steps = run_cod(article_text, mode="hierarchical")["steps"]
+                for i, item in enumerate(steps):
+                    slots.append(st.empty())
+                    with slots[-1].container():
+                        show_step(i, item)
+            else:
+                # Each summary is shown as soon as the model has finished writing it
+                for item in stream_cod(article_text, parser=parser):
+                    slots.append(st.empty())
+                    with slots[-1].container():
+                        show_step(len(steps), item)
+                    steps.append(item)
+                    progress_bar.progress(min(30 + 70 * len(steps) // STEPS, 99))
+        except openai.error.OpenAIError as e:
+            # Only reached once the gateway's retries are used up
+            st.error(f"The OpenAI API request failed: {e}")
+            st.stop()
+        except SchemaError as e:
+            st.error(f"The answer contained no usable summary ({e}).")
+            st.code(parser.text)
+            st.stop()
+
+        # Measured on the summaries themselves, then the best step is marked
+        result = score_result({"steps": steps}, article_text)
+        for i, (slot, item) in enumerate(zip(slots, steps)):
+            with slot.container():
+                show_step(i, item, result["metrics"][i], best=i == result["best_step"])
+
+        if parser.errors or len(steps) < STEPS:
+            st.warning(f"The answer was malformed; {len(steps)} of {STEPS} summaries were recovered.")
 
         # Display the raw JSON at the end with an explanation
         st.markdown("### Raw JSON Output")
         st.markdown("The following JSON contains all the details of the CoD operation. It's useful for developers or anyone interested in the raw data.")
-        st.code(result, language='json')
+        st.code(json.dumps({"steps": steps, "metrics": result["metrics"], "best_step": result["best_step"]}, indent=2), language='json')
 
         # Update the progress bar to indicate that the process is done
         progress_bar.progress(100)
 
-    except json.JSONDecodeError:
-        st.error("Failed to decode the result as JSON.")
-
-
+    # Where the time, tokens and money went
+    render_sidebar(trace)
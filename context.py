@@ -0,0 +1,217 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+import tiktoken
+
+from tracing import span
+
+# Context window per model family, matched on the longest prefix
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+DEFAULT_WINDOW = 4096
+CONTEXT_TOKENS = 8000  # default budget for article text, about what 30k characters used to be
+CHUNK_TOKENS = 256
+MESSAGE_OVERHEAD_TOKENS = 32  # chat formatting added around each request
+GAP_MARKER = "\n[...]\n"
+
+SIMILARITY_WEIGHT = 0.5
+ENTITY_WEIGHT = 0.4
+EDGE_BONUS = 0.1  # abstract and conclusions live in the first and last chunks
+SALIENCE_QUERY = "Article Summary"
+
+Chunk = namedtuple("Chunk", ["start", "end", "n_tokens"])
+
+NAME_OR_NUMBER = re.compile(r"\b(?:[A-Z][\w-]+|\d[\d.,%]*)")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    # A model name, or an encoding name such as "cl100k_base"
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        try:
+            return tiktoken.get_encoding(model)
+        except ValueError:
+            return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model):
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def context_window(model):
+    matches = [name for name in CONTEXT_WINDOWS if model.startswith(name)]
+    if not matches:
+        return DEFAULT_WINDOW
+    return CONTEXT_WINDOWS[max(matches, key=len)]
+
+
+def prompt_budget(model, prompt_tokens, completion_tokens):
+    # Tokens left for the article once the instructions and the answer are accounted for
+    return context_window(model) - prompt_tokens - completion_tokens - MESSAGE_OVERHEAD_TOKENS
+
+
+def token_offsets(text, encoding):
+    # Token ids of text and the character offset each token starts at
+    tokens = np.array(encoding.encode_ordinary(text), dtype=np.uint32)
+    byte_lengths = np.fromiter(map(len, encoding.decode_tokens_bytes(tokens.tolist())), dtype=np.int64,
+                               count=len(tokens))
+    byte_starts = np.cumsum(byte_lengths) - byte_lengths
+    # Character index of every UTF-8 byte; continuation bytes look like 0b10xxxxxx
+    data = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+    char_of_byte = np.cumsum((data & 0xC0) != 0x80, dtype=np.int64) - 1
+    return tokens, char_of_byte[byte_starts]
+
+
+def tokenize(text, model):
+    # Token ids and offsets of a whole document. The same article is measured, chunked
+    # for the index and chunked for the prompt in one run, so the last few are kept.
+    return _tokenize(text, get_encoding(model).name)
+
+
+@lru_cache(maxsize=8)
+def _tokenize(text, encoding_name):
+    tokens, offsets = token_offsets(text, get_encoding(encoding_name))
+    # Shared by every caller, so nobody may change them
+    tokens.flags.writeable = False
+    offsets.flags.writeable = False
+    return tokens, offsets
+
+
+def document_tokens(text, model):
+    # Token count of a long text, from the cached tokenization
+    return len(tokenize(text, model)[0])
+
+
+def token_windows(n_tokens, chunk_tokens, chunk_overlap=0):
+    # First and last (exclusive) token of each window; chunk_overlap tokens are shared with
+    # the previous one, and no trailing window lies entirely inside the one before
+    first = np.arange(0, n_tokens, chunk_tokens - chunk_overlap, dtype=np.int64)
+    last = np.minimum(first + chunk_tokens, n_tokens)
+    keep = np.searchsorted(last, n_tokens) + 1 if n_tokens else 0
+    return first[:keep], last[:keep]
+
+
+def token_chunks(text, model, chunk_tokens=CHUNK_TOKENS):
+    # Chunks are character spans into text aligned to token boundaries
+    tokens, offsets = tokenize(text, model)
+    first, last = token_windows(len(tokens), chunk_tokens)
+    ends = np.append(offsets, len(text))
+    return [Chunk(int(offsets[f]), int(ends[l]), int(l - f)) for f, l in zip(first, last)]
+
+
+def entity_density(text, chunks, entity_index=None):
+    # Entity mentions per token; without an index, names and numbers stand in for entities
+    if entity_index is not None:
+        counts = [entity_index.mentions_between(c.start, c.end) for c in chunks]
+    else:
+        counts = [len(NAME_OR_NUMBER.findall(text, c.start, c.end)) for c in chunks]
+    return np.array(counts, dtype=np.float32) / np.array([max(c.n_tokens, 1) for c in chunks], dtype=np.float32)
+
+
+def stored_chunks(store):
+    # Unit vectors and (start, end) text offsets of the chunks in a vector store, or None
+    # when its chunks carry no offsets (not made by chunking.TokenChunks)
+    if hasattr(store, "matrix"):
+        vectors, metadatas = store.matrix, store.metadatas
+    elif hasattr(store, "_collection"):
+        stored = store._collection.get(include=["embeddings", "metadatas"])
+        vectors, metadatas = stored["embeddings"], stored["metadatas"]
+    else:
+        return None
+    if not metadatas or any("start" not in m or "end" not in m for m in metadatas):
+        return None
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-9)
+    starts = np.array([m["start"] for m in metadatas], dtype=np.int64)
+    ends = np.array([m["end"] for m in metadatas], dtype=np.int64)
+    return vectors, starts, ends
+
+
+def retriever_similarities(retriever, chunks, query=SALIENCE_QUERY):
+    # Per chunk, the similarity to query of the best stored chunk overlapping it. Only the
+    # query is embedded; the text must be the document the retriever was built from.
+    store = getattr(retriever, "vectorstore", None)
+    stored = stored_chunks(store) if store is not None else None
+    if stored is None:
+        return None
+    vectors, starts, ends = stored
+    query_vector = np.asarray(store.embeddings.embed_query(query), dtype=np.float32)
+    scores = vectors @ query_vector / max(np.linalg.norm(query_vector), 1e-9)
+    similarities = np.full(len(chunks), scores.min(), dtype=np.float32)
+    for i, chunk in enumerate(chunks):
+        overlapping = (starts < chunk.end) & (ends > chunk.start)
+        if overlapping.any():
+            similarities[i] = scores[overlapping].max()
+    return similarities
+
+
+def article_entity_index(text):
+    # spaCy entities and their mention offsets; None (names and numbers instead) without a model
+    from entities import build_entity_index
+    try:
+        return build_entity_index(text)
+    except OSError:
+        return None
+
+
+def _rescale(scores):
+    scores = np.asarray(scores, dtype=np.float32)
+    spread = scores.max() - scores.min()
+    if spread <= 0:
+        return np.zeros_like(scores)
+    return (scores - scores.min()) / spread
+
+
+def salience(text, chunks, similarities=None, entity_index=None):
+    scores = ENTITY_WEIGHT * _rescale(entity_density(text, chunks, entity_index))
+    if similarities is not None:
+        scores += SIMILARITY_WEIGHT * _rescale(similarities)
+    scores[0] += EDGE_BONUS
+    scores[-1] += EDGE_BONUS
+    return scores
+
+
+def select_context(text, model, budget_tokens, similarities=None, entity_index=None, retriever=None,
+                   chunk_tokens=CHUNK_TOKENS):
+    # Returns the most salient chunks that fit in budget_tokens, in document order.
+    # Text that already fits is returned untouched. Without an entity_index one is built
+    # for text; the retriever, if any, must have been built from text.
+    chunks = token_chunks(text, model, chunk_tokens)
+    if sum(c.n_tokens for c in chunks) <= budget_tokens:
+        return text
+
+    if similarities is None and retriever is not None:
+        with span("retriever_similarity"):
+            similarities = retriever_similarities(retriever, chunks)
+    if entity_index is None:
+        entity_index = article_entity_index(text)
+    scores = salience(text, chunks, similarities, entity_index)
+
+    gap_tokens = count_tokens(GAP_MARKER, model)
+    used = 0
+    selected = []
+    for i in np.argsort(-scores, kind="stable"):
+        cost = chunks[i].n_tokens + gap_tokens
+        if used + cost <= budget_tokens:
+            selected.append(i)
+            used += cost
+
+    # Adjacent chunks are re-joined as one span; skipped text is marked
+    parts = []
+    previous = None
+    for i in sorted(selected):
+        chunk = chunks[i]
+        if previous is not None and previous == i - 1:
+            parts[-1] = (parts[-1][0], chunk.end)
+        else:
+            parts.append((chunk.start, chunk.end))
+        previous = i
+    return GAP_MARKER.join(text[start:end] for start, end in parts)
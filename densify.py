@@ -0,0 +1,59 @@
+import time
+
+# Decides, before every densification round of the iterative mode, whether another
+# round is worth its call. Short documents run out of entities after 2-3 rounds; the
+# remaining calls would only rewrite the same summary.
+
+MIN_DENSITY_GAIN = 0.005  # entities per token a round has to add to count as progress
+PATIENCE = 1  # rounds without progress before stopping
+
+# Why a run stopped, as recorded in run_cod's "stop_reason"
+MAX_STEPS = "max_steps"
+NO_MISSING_ENTITIES = "no_missing_entities"
+DENSITY_PLATEAU = "density_plateau"
+LATENCY_BUDGET = "latency_budget"
+TOKEN_BUDGET = "token_budget"
+ANSWER_ENDED = "answer_ended"  # single-call modes: the model wrote fewer steps than asked for
+
+
+class StopController:
+    def __init__(self, max_steps, max_seconds=None, max_tokens=None, min_density_gain=MIN_DENSITY_GAIN,
+                 patience=PATIENCE):
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+        self.min_density_gain = min_density_gain
+        self.patience = patience
+        self.start = time.perf_counter()
+        self.densities = []
+        self.step_seconds = []
+        self.step_tokens = []
+        self.stalled = 0
+        self.stop_reason = None
+
+    def record(self, density, seconds, tokens):
+        # After each round: the new summary's entities per token and what the round cost
+        if self.densities and density - self.densities[-1] < self.min_density_gain:
+            self.stalled += 1
+        else:
+            self.stalled = 0
+        self.densities.append(density)
+        self.step_seconds.append(seconds)
+        self.step_tokens.append(tokens)
+
+    def should_stop(self, missing_entities, tokens_used):
+        # Before each round. Budgets are checked against what an average round has cost,
+        # so the round that would overrun them is never started.
+        n = len(self.densities)
+        if n >= self.max_steps:
+            self.stop_reason = MAX_STEPS
+        elif n and not missing_entities:
+            self.stop_reason = NO_MISSING_ENTITIES
+        elif self.stalled >= self.patience:
+            self.stop_reason = DENSITY_PLATEAU
+        elif n and self.max_seconds is not None and \
+                time.perf_counter() - self.start + sum(self.step_seconds) / n > self.max_seconds:
+            self.stop_reason = LATENCY_BUDGET
+        elif n and self.max_tokens is not None and tokens_used + sum(self.step_tokens) / n > self.max_tokens:
+            self.stop_reason = TOKEN_BUDGET
+        return self.stop_reason is not None
@@ -0,0 +1,178 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from tracing import span
+
+DEFAULT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "embeddings")
+BATCH_SIZE = 1000  # texts per upstream request on a miss
+
+VECTORS_FILE = "vectors.f32"
+KEYS_FILE = "keys.txt"
+META_FILE = "meta.json"
+LOCK_FILE = ".lock"
+
+
+def embedding_key(text, model):
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+@contextmanager
+def _file_lock(path):
+    # Held while appending, so processes sharing a directory never hand out the same row
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class EmbeddingStore:
+    # Append-only float32 rows in a memory-mapped file, plus one key per row. Other
+    # processes may append to the same files; a row's number is its line in keys.txt.
+
+    def __init__(self, path, model):
+        self.path = path
+        self.model = model
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.n_rows = 0
+        self.keys_bytes = 0  # how much of keys.txt has been read
+        self.dim = None
+        self.vectors = None
+        os.makedirs(self.path, exist_ok=True)
+        self.refresh()
+
+    def refresh(self):
+        # Picks up rows appended by other processes since the last look
+        with _file_lock(os.path.join(self.path, LOCK_FILE)):
+            self._refresh()
+
+    def _refresh(self):
+        # Only called with the file lock held
+        if self.dim is None:
+            try:
+                with open(os.path.join(self.path, META_FILE)) as f:
+                    self.dim = json.load(f)["dim"]
+            except (OSError, ValueError, KeyError):
+                return
+        try:
+            with open(os.path.join(self.path, KEYS_FILE), "rb") as f:
+                f.seek(self.keys_bytes)
+                new = f.read()
+            vectors_path = os.path.join(self.path, VECTORS_FILE)
+            vectors_size = os.path.getsize(vectors_path)
+        except OSError:
+            return
+        new = new[:new.rfind(b"\n") + 1]
+        self.keys_bytes += len(new)
+        new_keys = new.decode("utf-8").split()
+        row_bytes = self.dim * 4
+        n_rows = min(self.n_rows + len(new_keys), vectors_size // row_bytes)
+        for key in new_keys[:n_rows - self.n_rows]:
+            self.rows[key] = self.n_rows
+            self.n_rows += 1
+        # A crash between the two appends leaves vector rows without a key
+        if vectors_size != n_rows * row_bytes:
+            os.truncate(vectors_path, n_rows * row_bytes)
+        self._map()
+
+    def _map(self):
+        if self.n_rows:
+            self.vectors = np.memmap(
+                os.path.join(self.path, VECTORS_FILE), dtype=np.float32, mode="r", shape=(self.n_rows, self.dim)
+            )
+
+    def append(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with _file_lock(os.path.join(self.path, LOCK_FILE)):
+            # Rows other processes added come first, so the new rows are numbered after them
+            self._refresh()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(os.path.join(self.path, META_FILE), "w") as f:
+                    json.dump({"model": self.model, "dim": self.dim}, f)
+            # Vectors first, keys second: a key is only ever written for a complete row
+            with open(os.path.join(self.path, VECTORS_FILE), "ab") as f:
+                f.write(vectors.tobytes())
+            lines = "".join(f"{key}\n" for key in keys).encode("utf-8")
+            with open(os.path.join(self.path, KEYS_FILE), "ab") as f:
+                f.write(lines)
+            self.keys_bytes += len(lines)
+            for key in keys:
+                self.rows[key] = self.n_rows
+                self.n_rows += 1
+            self._map()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _get_store(root, model):
+    # One store per directory per process, so row numbers never diverge
+    path = os.path.join(root, re.sub(r"[^A-Za-z0-9_.-]", "_", model))
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = EmbeddingStore(path, model)
+        return _stores[path]
+
+
+def _misses(store, keys, texts):
+    # Identical chunks within one call are embedded once
+    misses = {}
+    for key, text in zip(keys, texts):
+        if key not in store.rows and key not in misses:
+            misses[key] = text
+    return misses
+
+
+class CachedEmbeddings(Embeddings):
+    # Wraps any langchain Embeddings; only cache misses are sent upstream
+
+    def __init__(self, embeddings, root=None, batch_size=BATCH_SIZE):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", type(embeddings).__name__)
+        self.batch_size = batch_size
+        self.root = root
+
+    @property
+    def store(self):
+        # Without a root, DEFAULT_ROOT as it is now; fake_openai points it elsewhere
+        return _get_store(self.root or DEFAULT_ROOT, self.model)
+
+    def embed_documents(self, texts):
+        store = self.store
+        keys = [embedding_key(text, self.model) for text in texts]
+        with span("embed", model=self.model, texts=len(texts)) as current:
+            with store.lock:
+                misses = _misses(store, keys, texts)
+                if misses:
+                    # Another process may have embedded them already
+                    store.refresh()
+                    misses = _misses(store, keys, texts)
+            current.attrs["misses"] = len(misses)
+            # Upstream requests run without the lock, so hits in other sessions do not wait for them
+            miss_keys = list(misses)
+            for start in range(0, len(miss_keys), self.batch_size):
+                batch_keys = miss_keys[start:start + self.batch_size]
+                batch_vectors = self.embeddings.embed_documents([misses[key] for key in batch_keys])
+                with store.lock:
+                    store.append(batch_keys, batch_vectors)
+            with store.lock:
+                vectors = store.vectors
+                rows = [store.rows[key] for key in keys]
+        if not rows:
+            return []
+        return vectors[rows].tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
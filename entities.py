@@ -0,0 +1,124 @@
+import bisect
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+from tracing import span
+
+MODEL_NAME = "en_core_web_sm"
+
+# NER only needs tok2vec + ner, the rest of the pipeline is wasted work
+EXCLUDED_COMPONENTS = ["tagger", "parser", "attribute_ruler", "lemmatizer", "senter"]
+
+CHUNK_CHARS = 50000  # well below spaCy's default max_length of 1,000,000
+MULTIPROCESS_CHARS = 500000  # documents above this are parsed across processes
+BATCH_SIZE = 8
+
+Entity = namedtuple("Entity", ["text", "label", "norm", "count", "first_pos"])
+
+_LEADING_ARTICLE = re.compile(r"^(the|a|an)\s+", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+_EDGE_PUNCT = " \t\n\"'`.,;:()[]{}"
+
+
+@lru_cache(maxsize=None)
+def load_nlp(model=MODEL_NAME):
+    # Loaded once per process, every round and every document share it
+    with span("spacy_load", model=model):
+        # spaCy itself takes about a second to import, so it waits for the first parse
+        import spacy
+        return spacy.load(model, exclude=EXCLUDED_COMPONENTS)
+
+
+def normalize_entity(text):
+    norm = _WHITESPACE.sub(" ", text).strip(_EDGE_PUNCT)
+    norm = _LEADING_ARTICLE.sub("", norm)
+    norm = norm.lower()
+    if norm.endswith("'s"):
+        norm = norm[:-2]
+    return norm
+
+
+def split_text(text, chunk_chars=CHUNK_CHARS):
+    # Cut on paragraph/sentence boundaries so entities are not split in two
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_chars, len(text))
+        if end < len(text):
+            cut = text.rfind("\n", start + chunk_chars // 2, end)
+            if cut == -1:
+                cut = text.rfind(". ", start + chunk_chars // 2, end)
+            if cut != -1:
+                end = cut + 1
+        chunks.append((text[start:end], start))
+        start = end
+    return chunks
+
+
+class EntityIndex:
+    def __init__(self, entities, mention_offsets=()):
+        # Ranked by frequency, then by first appearance in the document
+        self.entities = sorted(entities, key=lambda e: (-e.count, e.first_pos))
+        self.by_norm = {e.norm: e for e in self.entities}
+        self.mention_offsets = sorted(mention_offsets)
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __contains__(self, text):
+        return normalize_entity(text) in self.by_norm
+
+    def missing(self, included_entities, limit=3):
+        included = {normalize_entity(text) for text in included_entities}
+        missing_entities = []
+        for entity in self.entities:
+            if entity.norm in included:
+                continue
+            missing_entities.append(entity.text)
+            if len(missing_entities) == limit:
+                break
+        return missing_entities
+
+    def found_in(self, text):
+        # Entities of the index that text mentions, e.g. a summary of the indexed article
+        norm = f" {normalize_entity(text)} "
+        return [entity for entity in self.entities if f" {entity.norm}" in norm]
+
+    def mentions_between(self, start, end):
+        # Number of entity mentions starting in text[start:end]
+        return bisect.bisect_left(self.mention_offsets, end) - bisect.bisect_left(self.mention_offsets, start)
+
+
+def build_entity_index(text, n_process=None, chunk_chars=CHUNK_CHARS):
+    nlp = load_nlp()
+    chunks = split_text(text, chunk_chars)
+    if n_process is None:
+        n_process = min(os.cpu_count() or 1, 4) if len(text) > MULTIPROCESS_CHARS else 1
+
+    counts = {}
+    mention_offsets = []
+    with span("ner", chars=len(text), n_process=n_process):
+        for doc, offset in nlp.pipe(chunks, as_tuples=True, batch_size=BATCH_SIZE, n_process=n_process):
+            for ent in doc.ents:
+                norm = normalize_entity(ent.text)
+                if not norm:
+                    continue
+                mention_offsets.append(offset + ent.start_char)
+                if norm in counts:
+                    counts[norm][3] += 1
+                else:
+                    counts[norm] = [ent.text.strip(), ent.label_, norm, 1, offset + ent.start_char]
+
+    return EntityIndex([Entity(*fields) for fields in counts.values()], mention_offsets)
+
+
+def text_entities(texts, n_process=1, batch_size=256):
+    # Normalized entities of many short texts (e.g. summaries), one NER pass over all of them
+    nlp = load_nlp()
+    with span("ner", texts=len(texts), n_process=n_process):
+        return [
+            {norm for norm in (normalize_entity(ent.text) for ent in doc.ents) if norm}
+            for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+        ]
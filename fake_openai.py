@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import openai
+from openai.openai_object import OpenAIObject
+
+import llm_cache
+from llm_cache import cache_key
+
+EMBEDDING_DIM = 1536
+SUMMARY_WORDS = 80
+
+_CANDIDATE_ENTITY = re.compile(r"\b[A-Z][a-zA-Z-]{2,}(?:\s+[A-Z][a-zA-Z-]{2,})?")
+
+
+def _fake_tokens(text):
+    # Close enough to cl100k for benchmarking, and needs no tokenizer files
+    return max(1, len(text) // 4)
+
+
+def fake_embedding(text, dim=EMBEDDING_DIM):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def _entities(text, limit):
+    seen = []
+    for match in _CANDIDATE_ENTITY.findall(text):
+        if match not in seen:
+            seen.append(match)
+        if len(seen) == limit:
+            break
+    return seen
+
+
+def _summary(entities):
+    words = "This article discusses".split() + [word for entity in entities for word in entity.split()]
+    filler = "and describes its findings in some detail for the reader".split()
+    while len(words) < SUMMARY_WORDS:
+        words.extend(filler)
+    return " ".join(words[:SUMMARY_WORDS]) + "."
+
+
+def fake_chat_content(messages):
+    # Deterministic stand-ins shaped like the real answers the pipeline parses
+    prompt = messages[-1]["content"]
+    if "Answer in JSON" in prompt:
+        entities = _entities(prompt, 15)
+        steps = []
+        for i in range(5):
+            new = entities[i * 3:i * 3 + 3]
+            steps.append({"Missing_Entities": "; ".join(new), "Denser_Summary": _summary(entities[:i * 3 + 3])})
+        return json.dumps(steps)
+    return _summary(_entities(prompt, 12))
+
+
+def fake_chat_response(params):
+    content = fake_chat_content(params["messages"])
+    prompt_tokens = sum(_fake_tokens(message["content"]) for message in params["messages"])
+    completion_tokens = _fake_tokens(content)
+    return {
+        "id": "chatcmpl-offline",
+        "object": "chat.completion",
+        "model": params.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def stream_chunks(response, piece_chars=16):
+    # A complete response replayed as stream=True chunks
+    content = response["choices"][0]["message"]["content"]
+    for start in range(0, len(content), piece_chars):
+        delta = {"content": content[start:start + piece_chars]}
+        if start == 0:
+            delta["role"] = "assistant"
+        yield OpenAIObject.construct_from({
+            "object": "chat.completion.chunk",
+            "model": response.get("model"),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+        })
+    yield OpenAIObject.construct_from({
+        "object": "chat.completion.chunk",
+        "model": response.get("model"),
+        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+    })
+
+
+def fake_embedding_response(params):
+    inputs = params["input"]
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    # langchain may send token id lists instead of strings
+    texts = [text if isinstance(text, str) else " ".join(map(str, text)) for text in inputs]
+    tokens = sum(_fake_tokens(text) for text in texts)
+    return {
+        "object": "list",
+        "model": params.get("model"),
+        "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(text)} for i, text in enumerate(texts)],
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+class OfflineOpenAI:
+    # Patches openai.ChatCompletion and openai.Embedding for the duration of a with block.
+    # Without a cassette every call is answered by the fakes above. With a cassette,
+    # recorded responses are replayed; record=True calls the real API and saves them.
+    # The response cache, embedding cache and index store are swapped for throwaway ones
+    # in a temporary directory, so no fake answer ever lands in the persistent caches.
+
+    def __init__(self, cassette=None, record=False, latency=0.0):
+        self.cassette = cassette
+        self.record = record
+        self.latency = latency
+        self.calls = {"chat": 0, "embedding": 0}
+        self._tape = {"chat": {}, "embedding": {}}
+        self._saved = {}
+        self._tmpdir = None
+
+    def _respond(self, kind, params, upstream, fake):
+        self.calls[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        key = cache_key(params)
+        if key in self._tape[kind]:
+            return OpenAIObject.construct_from(self._tape[kind][key])
+        if self.record:
+            response = upstream(**params)
+            self._tape[kind][key] = response.to_dict_recursive()
+            return response
+        if self.cassette is not None:
+            raise KeyError(f"No recorded {kind} response in {self.cassette} for request {key}")
+        return OpenAIObject.construct_from(fake(params))
+
+    def __enter__(self):
+        if self.cassette is not None and os.path.exists(self.cassette) and not self.record:
+            with open(self.cassette) as f:
+                self._tape = json.load(f)
+
+        self._saved = {
+            (openai.ChatCompletion, "create"): openai.ChatCompletion.__dict__["create"],
+            (openai.ChatCompletion, "acreate"): openai.ChatCompletion.__dict__["acreate"],
+            (openai.Embedding, "create"): openai.Embedding.__dict__["create"],
+            (openai.Embedding, "acreate"): openai.Embedding.__dict__["acreate"],
+        }
+        chat_upstream = openai.ChatCompletion.create
+        embedding_upstream = openai.Embedding.create
+
+        def chat_create(**params):
+            if params.get("stream"):
+                # Recorded and faked as a whole answer, handed out in pieces
+                params = {k: v for k, v in params.items() if k != "stream"}
+                return stream_chunks(self._respond("chat", params, chat_upstream, fake_chat_response))
+            return self._respond("chat", params, chat_upstream, fake_chat_response)
+
+        async def chat_acreate(**params):
+            return await asyncio.to_thread(chat_create, **params)
+
+        def embedding_create(**params):
+            return self._respond("embedding", params, embedding_upstream, fake_embedding_response)
+
+        async def embedding_acreate(**params):
+            return await asyncio.to_thread(embedding_create, **params)
+
+        import embedding_cache
+        import index_store
+        self._tmpdir = tempfile.mkdtemp(prefix="cod-offline-")
+        self._saved_caches = {
+            (llm_cache, "_default_cache"): llm_cache._default_cache,
+            (embedding_cache, "DEFAULT_ROOT"): embedding_cache.DEFAULT_ROOT,
+            (index_store, "_default_store"): index_store._default_store,
+        }
+        llm_cache._default_cache = llm_cache.ResponseCache(os.path.join(self._tmpdir, "llm.sqlite3"))
+        embedding_cache.DEFAULT_ROOT = os.path.join(self._tmpdir, "embeddings")
+        index_store._default_store = index_store.IndexStore(os.path.join(self._tmpdir, "collections"))
+
+        openai.ChatCompletion.create = staticmethod(chat_create)
+        openai.ChatCompletion.acreate = staticmethod(chat_acreate)
+        openai.Embedding.create = staticmethod(embedding_create)
+        openai.Embedding.acreate = staticmethod(embedding_acreate)
+        if not self.record:
+            os.environ.setdefault("OPENAI_API_KEY", "sk-offline")
+            openai.api_key = openai.api_key or "sk-offline"
+        return self
+
+    def __exit__(self, *exc_info):
+        for (cls, name), attribute in self._saved.items():
+            setattr(cls, name, attribute)
+        llm_cache._default_cache.close()
+        for (module, name), value in self._saved_caches.items():
+            setattr(module, name, value)
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+        if self.record and self.cassette is not None:
+            with open(self.cassette, "w") as f:
+                json.dump(self._tape, f)
+        return False
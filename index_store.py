@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+from tracing import span
+
+DEFAULT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".chroma", "collections")
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
+
+MAX_COLLECTIONS = 50  # collections kept on disk
+MAX_BYTES = 2 * 1024 ** 3  # disk budget for all collections
+MAX_OPEN = 4  # collections kept open in memory
+# Corpora up to this many chunks are searched with an in-process NumPy matrix and never
+# persisted (their embeddings are cached on disk anyway); larger ones go to Chroma.
+NUMPY_MAX_CHUNKS = int(os.getenv("COD_NUMPY_MAX_CHUNKS", 5000))
+
+MANIFEST = "manifest.json"
+COMPLETE_MARKER = ".complete"
+
+
+def pdf_digest(pdf_bytes):
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def collection_key(pdf_hash, chunk_size, chunk_overlap, embedding_model=DEFAULT_EMBEDDING_MODEL,
+                   splitter="document_tokens"):
+    # Same PDF + same splitter + same embeddings => same collection
+    key = f"{pdf_hash}|{splitter}|{chunk_size}|{chunk_overlap}|{embedding_model}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+class IndexStore:
+    def __init__(self, root=DEFAULT_ROOT, max_collections=MAX_COLLECTIONS, max_bytes=MAX_BYTES, max_open=MAX_OPEN,
+                 numpy_max_chunks=NUMPY_MAX_CHUNKS):
+        self.root = root
+        self.numpy_max_chunks = numpy_max_chunks
+        self.max_collections = max_collections
+        self.max_bytes = max_bytes
+        self.max_open = max_open
+        self._open = OrderedDict()
+        self._lock = threading.RLock()  # guards _open and the manifest, never held while building
+        self._key_locks = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def _load_manifest(self):
+        try:
+            with open(os.path.join(self.root, MANIFEST)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, manifest):
+        path = os.path.join(self.root, MANIFEST)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+
+    def _collection_name(self, key):
+        return f"cod_{key[:40]}"
+
+    def _remember(self, key, vectordb):
+        self._open[key] = vectordb
+        self._open.move_to_end(key)
+        while len(self._open) > self.max_open:
+            self._open.popitem(last=False)
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get_or_create(self, key, build_chunks, embeddings):
+        # build_chunks is only called on a miss, so hits skip loading and splitting too.
+        # Building holds only this key's lock: hits on other documents never wait for it.
+        from vector_index import NumpyVectorStore
+        with span("index", key=key[:12]) as current:
+            with self._lock:
+                vectordb = self._open_hit(key)
+            current.attrs["hit"] = vectordb is not None
+            if vectordb is None:
+                with self._key_lock(key):
+                    # Another thread may have finished it while this one waited
+                    with self._lock:
+                        vectordb = self._open_hit(key)
+                    if vectordb is None:
+                        vectordb = self._load_or_build(key, build_chunks, embeddings, current)
+                        with self._lock:
+                            self._remember(key, vectordb)
+            if isinstance(vectordb, NumpyVectorStore):
+                return vectordb
+            current.attrs["backend"] = "chroma"
+            with self._lock:
+                manifest = self._load_manifest()
+                entry = manifest.get(key) or {"bytes": _dir_size(self._path(key))}
+                entry["last_used"] = time.time()
+                manifest[key] = entry
+                self._evict(manifest, keep=key)
+                self._save_manifest(manifest)
+            return vectordb
+
+    def _open_hit(self, key):
+        # Only called with the store lock held
+        vectordb = self._open.get(key)
+        if vectordb is not None:
+            self._open.move_to_end(key)
+        return vectordb
+
+    def _load_or_build(self, key, build_chunks, embeddings, current):
+        from vector_index import NumpyVectorStore
+        if os.path.exists(os.path.join(self._path(key), COMPLETE_MARKER)):
+            current.attrs["hit"] = True
+            return self._chroma(key, embeddings)
+        chunks = build_chunks()
+        if len(chunks) <= self.numpy_max_chunks:
+            current.attrs["backend"] = "numpy"
+            return NumpyVectorStore.from_documents(chunks, embeddings)
+        return self._build_chroma(key, chunks, embeddings)
+
+    def _chroma(self, key, embeddings):
+        # chromadb is only imported for corpora too large for the NumPy index
+        from langchain.vectorstores import Chroma
+        return Chroma(
+            collection_name=self._collection_name(key),
+            embedding_function=embeddings,
+            persist_directory=self._path(key),
+        )
+
+    def _build_chroma(self, key, chunks, embeddings):
+        from langchain.vectorstores import Chroma
+        path = self._path(key)
+        shutil.rmtree(path, ignore_errors=True)
+        vectordb = Chroma.from_documents(
+            chunks,
+            embeddings,
+            collection_name=self._collection_name(key),
+            persist_directory=path,
+        )
+        vectordb.persist()
+        open(os.path.join(path, COMPLETE_MARKER), "w").close()
+        return vectordb
+
+    def _evict(self, manifest, keep=None):
+        # Drop least recently used collections until both budgets are met
+        lru = sorted((k for k in manifest if k != keep), key=lambda k: manifest[k]["last_used"])
+        total_bytes = sum(entry["bytes"] for entry in manifest.values())
+        while lru and (len(manifest) > self.max_collections or total_bytes > self.max_bytes):
+            key = lru.pop(0)
+            total_bytes -= manifest.pop(key)["bytes"]
+            self._open.pop(key, None)
+            shutil.rmtree(self._path(key), ignore_errors=True)
+
+    def clear(self):
+        with self._lock:
+            self._open.clear()
+            shutil.rmtree(self.root, ignore_errors=True)
+            os.makedirs(self.root, exist_ok=True)
+
+
+_default_store = None
+
+
+def default_store():
+    # One store per process, shared by every Streamlit session and rerun
+    global _default_store
+    if _default_store is None:
+        _default_store = IndexStore()
+    return _default_store
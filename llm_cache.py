@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from context import count_tokens
+from llm_gateway import default_gateway
+from tracing import record_usage, span
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "llm.sqlite3")
+MEMORY_ENTRIES = 256
+TTL_SECONDS = 7 * 24 * 3600
+MAX_BYTES = 256 * 1024 ** 2
+
+# Request options that do not change what the model returns
+IGNORED_PARAMS = {"api_key", "api_base", "api_type", "api_version", "organization", "request_timeout", "request_id"}
+
+
+def cache_key(params):
+    # Canonical JSON, so dict ordering and whitespace never cause a miss
+    canonical = {k: v for k, v in params.items() if k not in IGNORED_PARAMS}
+    payload = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    # In-memory LRU in front of a SQLite table, both with the same TTL
+
+    def __init__(self, path=DEFAULT_PATH, memory_entries=MEMORY_ENTRIES, ttl=TTL_SECONDS, max_bytes=MAX_BYTES):
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, "
+            "last_used REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._expire()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            if key in self._memory:
+                created, response = self._memory[key]
+                if now - created < self.ttl:
+                    self._memory.move_to_end(key)
+                    return response
+                del self._memory[key]
+
+            row = self._db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            response, created = row
+            if now - created >= self.ttl:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            response = json.loads(response)
+            self._remember(key, created, response)
+            return response
+
+    def put(self, key, response):
+        now = time.time()
+        payload = json.dumps(response, separators=(",", ":"))
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created, last_used, size) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, now, now, len(payload)),
+            )
+            self._remember(key, now, response)
+            self._evict()
+
+    def _remember(self, key, created, response):
+        self._memory[key] = (created, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _expire(self):
+        self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+
+    def _evict(self):
+        # Least recently used rows go first once the table is over budget
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        self._expire()
+        freed = 0
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+            if total - freed <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._memory.pop(key, None)
+            freed += size
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._db.execute("DELETE FROM responses")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_default_cache = None
+
+
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResponseCache()
+    return _default_cache
+
+
+def _as_response(data):
+    # Cached responses support both response['choices'] and response.choices
+    from openai.openai_object import OpenAIObject
+    return OpenAIObject.construct_from(data)
+
+
+def chat_completion(cache=True, **params):
+    # Drop-in for openai.ChatCompletion.create; streamed calls are never cached.
+    # Misses go through the gateway, so identical concurrent misses make one request.
+    with span("llm", model=params.get("model")) as current:
+        if not cache or params.get("stream"):
+            return default_gateway().create(**params)
+        key = cache_key(params)
+        cached = default_cache().get(key)
+        current.attrs["cached"] = cached is not None
+        if cached is not None:
+            return _as_response(cached)
+        response = default_gateway().create(key=key, **params)
+        default_cache().put(key, response.to_dict_recursive())
+        return response
+
+
+async def achat_completion(cache=True, **params):
+    with span("llm", model=params.get("model")) as current:
+        if not cache or params.get("stream"):
+            return await default_gateway().acreate(**params)
+        key = cache_key(params)
+        cached = default_cache().get(key)
+        current.attrs["cached"] = cached is not None
+        if cached is not None:
+            return _as_response(cached)
+        response = await default_gateway().acreate(key=key, **params)
+        default_cache().put(key, response.to_dict_recursive())
+        return response
+
+
+def _stream_usage(params, content):
+    # Streamed answers come without usage, so it is counted here
+    model = params.get("model") or ""
+    prompt_tokens = sum(count_tokens(m.get("content") or "", model) + 4 for m in params.get("messages", []))
+    completion_tokens = count_tokens(content, model)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def stream_chat_completion(**params):
+    # Yields the answer text as it arrives. A finished answer is cached under the same key
+    # as the unstreamed request, so asking again yields it at once, in one piece.
+    key = cache_key(params)
+    with span("llm", model=params.get("model"), stream=True) as current:
+        cached = default_cache().get(key)
+        current.attrs["cached"] = cached is not None
+        if cached is not None:
+            yield cached["choices"][0]["message"]["content"]
+            return
+        parts = []
+        finish_reason = None
+        for chunk in default_gateway().create(stream=True, **params):
+            choice = chunk["choices"][0]
+            delta = choice.get("delta", {}).get("content")
+            if delta:
+                parts.append(delta)
+                yield delta
+            finish_reason = choice.get("finish_reason") or finish_reason
+        content = "".join(parts)
+        response = {
+            "object": "chat.completion",
+            "model": params.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": finish_reason}],
+            "usage": _stream_usage(params, content),
+        }
+        record_usage(response, params.get("model"))
+        if finish_reason == "stop":
+            # A cut-off answer is not worth keeping
+            default_cache().put(key, response)
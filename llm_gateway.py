@@ -0,0 +1,267 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+
+import requests
+
+from tracing import record_usage, span
+
+# openai and aiohttp are imported where they are used; importing them costs half a second
+# that a Streamlit page should not pay before its first request.
+
+# (requests per minute, tokens per minute), matched on the longest model prefix.
+# COD_RPM / COD_TPM override them for every model.
+LIMITS = {
+    "gpt-3.5-turbo": (3500, 90000),
+    "gpt-3.5-turbo-16k": (3500, 180000),
+    "gpt-4": (200, 40000),
+    "gpt-4-32k": (200, 80000),
+}
+DEFAULT_LIMITS = (3500, 90000)
+
+MAX_RETRIES = 6
+BASE_DELAY = 1.0  # seconds before the first retry, doubled after each attempt
+MAX_DELAY = 60.0
+POOL_SIZE = 32  # keep-alive connections to the API shared by all threads
+COMPLETION_RESERVE = 500  # tokens held for calls without max_tokens
+
+
+class TokenBucket:
+    # Refills continuously; holds at most one minute's worth
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        # Takes amount now, going into debt if needed; returns seconds to wait before using it.
+        # Later callers queue behind the debt, so waiters are served in order.
+        amount = min(amount, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            self.level -= amount
+            return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount):
+        # Negative amounts charge for an underestimate
+        with self.lock:
+            self.level = min(self.capacity, self.level + amount)
+
+
+def limits_for(model):
+    rpm, tpm = DEFAULT_LIMITS
+    matches = [name for name in LIMITS if model and model.startswith(name)]
+    if matches:
+        rpm, tpm = LIMITS[max(matches, key=len)]
+    return int(os.getenv("COD_RPM", rpm)), int(os.getenv("COD_TPM", tpm))
+
+
+def estimate_tokens(params):
+    # About 4 characters per token; corrected with the real usage once the answer is back
+    chars = sum(len(message.get("content") or "") for message in params.get("messages", []))
+    return chars // 4 + 4 * len(params.get("messages", [])) + (params.get("max_tokens") or COMPLETION_RESERVE)
+
+
+def _retry_after(error):
+    try:
+        return float(error.headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def is_retryable(error):
+    import openai
+    if isinstance(error, (openai.error.RateLimitError, openai.error.ServiceUnavailableError,
+                          openai.error.APIConnectionError, openai.error.Timeout, openai.error.TryAgain)):
+        return True
+    return isinstance(error, openai.error.APIError) and (error.http_status or 0) >= 500
+
+
+class _SharedAdapter(requests.adapters.HTTPAdapter):
+    def close(self):
+        # openai closes its per-thread session every few minutes; the pool outlives it
+        pass
+
+
+_adapter = None
+
+
+def _pooled_session():
+    # openai keeps one session per thread and Streamlit runs every rerun on a new thread,
+    # so the sessions share one adapter and therefore one connection pool
+    import openai
+    global _adapter
+    if _adapter is None:
+        _adapter = _SharedAdapter(pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=2)
+    session = requests.Session()
+    session.mount("https://", _adapter)
+    if openai.proxy:
+        session.proxies = openai.proxy if isinstance(openai.proxy, dict) else {"http": openai.proxy, "https": openai.proxy}
+    return session
+
+
+@asynccontextmanager
+async def pooled_aiosession(limit=POOL_SIZE):
+    # Without this openai opens a new aiohttp session, and connection, for every async call.
+    # Tasks created inside the block inherit the session.
+    import aiohttp
+    import openai
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit)) as session:
+        token = openai.aiosession.set(session)
+        try:
+            yield session
+        finally:
+            openai.aiosession.reset(token)
+
+
+class LLMGateway:
+    # Every chat call in the process goes through here: rate limits, retries and in-flight dedup
+
+    def __init__(self, max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._buckets = {}
+        self._inflight = {}
+        self._ainflight = {}
+        self._lock = threading.Lock()
+        import openai
+        # Pages import openai lazily, possibly after .env was loaded; the key is taken from there
+        openai.api_key = openai.api_key or os.getenv("OPENAI_API_KEY")
+        if openai.requestssession is None:
+            openai.requestssession = _pooled_session
+
+    def _buckets_for(self, model):
+        with self._lock:
+            if model not in self._buckets:
+                rpm, tpm = limits_for(model)
+                self._buckets[model] = (TokenBucket(rpm), TokenBucket(tpm))
+            return self._buckets[model]
+
+    def _reserve(self, params):
+        requests_bucket, tokens_bucket = self._buckets_for(params.get("model"))
+        estimate = estimate_tokens(params)
+        wait = max(requests_bucket.reserve(1), tokens_bucket.reserve(estimate))
+        return tokens_bucket, estimate, wait
+
+    def _settle(self, response, params, tokens_bucket, estimate):
+        if params.get("stream"):
+            return
+        usage = response.get("usage") or {}
+        tokens_bucket.refund(estimate - usage.get("total_tokens", estimate))
+        record_usage(response, params.get("model"))
+
+    def _backoff(self, error, attempt):
+        # Full jitter, so sessions that failed together do not retry together
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, _retry_after(error))
+
+    def _call(self, params):
+        import openai
+        for attempt in range(self.max_retries + 1):
+            tokens_bucket, estimate, wait = self._reserve(params)
+            if wait:
+                with span("rate_limit_wait", seconds=round(wait, 3)):
+                    time.sleep(wait)
+            try:
+                response = openai.ChatCompletion.create(**params)
+            except openai.error.OpenAIError as e:
+                tokens_bucket.refund(estimate)
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                delay = self._backoff(e, attempt)
+                with span("retry", attempt=attempt + 1, error=type(e).__name__, seconds=round(delay, 3)):
+                    time.sleep(delay)
+                continue
+            self._settle(response, params, tokens_bucket, estimate)
+            return response
+
+    async def _acall(self, params):
+        import openai
+        for attempt in range(self.max_retries + 1):
+            tokens_bucket, estimate, wait = self._reserve(params)
+            if wait:
+                with span("rate_limit_wait", seconds=round(wait, 3)):
+                    await asyncio.sleep(wait)
+            try:
+                response = await openai.ChatCompletion.acreate(**params)
+            except openai.error.OpenAIError as e:
+                tokens_bucket.refund(estimate)
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                delay = self._backoff(e, attempt)
+                with span("retry", attempt=attempt + 1, error=type(e).__name__, seconds=round(delay, 3)):
+                    await asyncio.sleep(delay)
+                continue
+            self._settle(response, params, tokens_bucket, estimate)
+            return response
+
+    def create(self, key=None, **params):
+        # Calls with the same key that overlap share one upstream request; streams are never shared
+        if key is None or params.get("stream"):
+            return self._call(params)
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            with span("dedup_wait"):
+                return future.result()
+        try:
+            response = self._call(params)
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    async def acreate(self, key=None, **params):
+        if key is None or params.get("stream"):
+            return await self._acall(params)
+        # asyncio futures belong to one event loop
+        inflight_key = (id(asyncio.get_running_loop()), key)
+        future = self._ainflight.get(inflight_key)
+        if future is not None:
+            with span("dedup_wait"):
+                return await asyncio.shield(future)
+        future = self._ainflight[inflight_key] = asyncio.get_running_loop().create_future()
+        try:
+            response = await self._acall(params)
+            future.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody may be waiting; keeps asyncio from warning about an unread exception
+            future.exception()
+            raise
+        finally:
+            del self._ainflight[inflight_key]
+
+
+_default_gateway = None
+_default_gateway_lock = threading.Lock()
+
+
+def default_gateway():
+    # One gateway per process, so every Streamlit session shares the same budgets
+    global _default_gateway
+    with _default_gateway_lock:
+        if _default_gateway is None:
+            _default_gateway = LLMGateway()
+        return _default_gateway
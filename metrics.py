@@ -0,0 +1,194 @@
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from context import NAME_OR_NUMBER, get_encoding
+from entities import normalize_entity, text_entities
+from tracing import span
+
+# The CoD paper finds people prefer summaries about as dense as human-written ones,
+# around 0.15 entities per token; the best step is the valid one closest to that.
+TARGET_DENSITY = 0.15
+MAX_WORD_DRIFT = 0.2  # "identical length": words may drift this fraction from the first step
+MIN_RETENTION = 0.8  # "never drop entities": share of the previous step's entities kept
+RUNS_PER_BATCH = 512  # runs scored together; bounds memory when sources are long
+TOKEN_MODEL = "gpt-3.5-turbo"
+
+FIELDS = ["words", "tokens", "entities", "word_drift", "entity_density", "retention", "novelty", "valid"]
+
+
+def regex_entities(texts):
+    # Capitalized words and numbers; for machines without a spaCy model
+    return [{normalize_entity(match) for match in NAME_OR_NUMBER.findall(text)} for text in texts]
+
+
+class StepMetrics:
+    # One row per step of every run, as flat arrays; run and step locate a row
+
+    def __init__(self, run, step, n_runs, **columns):
+        self.run = run
+        self.step = step
+        for name in FIELDS:
+            setattr(self, name, columns[name])
+        # -1 for runs without steps
+        self.best_step = best_steps(run, step, columns["entity_density"], columns["valid"], n_runs)
+
+    def for_run(self, i):
+        # Rows are grouped by run
+        rows = range(np.searchsorted(self.run, i), np.searchsorted(self.run, i, side="right"))
+        return [
+            {name: _plain(getattr(self, name)[row]) for name in FIELDS}
+            for row in rows
+        ]
+
+    @classmethod
+    def concatenate(cls, parts, run_offsets):
+        run = np.concatenate([part.run + offset for part, offset in zip(parts, run_offsets)])
+        step = np.concatenate([part.step for part in parts])
+        columns = {name: np.concatenate([getattr(part, name) for part in parts]) for name in FIELDS}
+        return cls(run, step, sum(len(part.best_step) for part in parts), **columns)
+
+
+def _plain(value):
+    if isinstance(value, np.bool_):
+        return bool(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    value = float(value)
+    return None if np.isnan(value) else round(value, 4)
+
+
+def best_steps(run, step, density, valid, n_runs):
+    # Per run: valid steps first, then closest to TARGET_DENSITY, then the earliest
+    best = np.full(n_runs, -1, dtype=np.int64)
+    if len(run) == 0:
+        return best
+    penalty = np.abs(density - TARGET_DENSITY) + (~valid) * 1.0
+    order = np.lexsort((step, penalty, run))
+    _, first = np.unique(run[order], return_index=True)
+    best[run[order][first]] = step[order][first]
+    return best
+
+
+def _ragged(lists, dtype=np.int64):
+    # Flat values plus the index of the list each value came from
+    lengths = np.fromiter((len(values) for values in lists), dtype=np.int64, count=len(lists))
+    owner = np.repeat(np.arange(len(lists)), lengths)
+    flat = np.fromiter((value for values in lists for value in values), dtype=dtype, count=int(lengths.sum()))
+    return flat, owner, lengths
+
+
+def _bigram_keys(tokens, owner, group, n_vocab):
+    # Adjacent token pairs inside the same text, as one int64 per pair, prefixed by group
+    same = owner[1:] == owner[:-1]
+    first, second = tokens[:-1][same], tokens[1:][same]
+    return (group[owner[:-1][same]] * n_vocab + first) * n_vocab + second, owner[:-1][same]
+
+
+def _score_batch(runs, sources, model, entity_fn):
+    run_lengths = np.fromiter((len(r) for r in runs), dtype=np.int64, count=len(runs))
+    run = np.repeat(np.arange(len(runs)), run_lengths)
+    starts = np.cumsum(run_lengths) - run_lengths
+    step = np.arange(len(run)) - np.repeat(starts, run_lengths)
+    texts = [s["Denser_Summary"] for steps in runs for s in steps]
+    n = len(texts)
+    encoding = get_encoding(model)
+
+    # Everything below works on these arrays; the only per-text work is tokenizing and NER
+    words = np.fromiter((len(text.split()) for text in texts), dtype=np.int64, count=n)
+    tokens, token_owner, n_tokens = _ragged(encoding.encode_ordinary_batch(texts))
+    entity_sets = entity_fn(texts)
+    vocab = {}
+    entity_ids, entity_owner, n_entities = _ragged([[vocab.setdefault(e, len(vocab)) for e in ents]
+                                                    for ents in entity_sets])
+
+    first_words = words[np.repeat(starts, run_lengths)]
+    word_drift = (words - first_words) / np.maximum(first_words, 1)
+    entity_density = n_entities / np.maximum(n_tokens, 1)
+
+    # Retention: previous step's entities found again in this step, by (row, entity) keys
+    n_vocab_entities = max(len(vocab), 1)
+    has_next = np.append(run[1:] == run[:-1], False)
+    keys = entity_owner * n_vocab_entities + entity_ids
+    asked = has_next[entity_owner]
+    found = np.isin((entity_owner[asked] + 1) * n_vocab_entities + entity_ids[asked], keys)
+    kept = np.bincount(entity_owner[asked], weights=found, minlength=n)
+    retention = np.full(n, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        previous = np.flatnonzero(has_next)
+        retention[previous + 1] = np.where(n_entities[previous] > 0, kept[previous] / n_entities[previous], 1.0)
+
+    # Novelty: share of the summary's token bigrams that never occur in its source
+    novelty = np.full(n, np.nan)
+    if sources is not None:
+        source_tokens, source_owner, _ = _ragged(encoding.encode_ordinary_batch(sources))
+        source_keys, _ = _bigram_keys(source_tokens, source_owner, np.arange(len(runs)), encoding.n_vocab)
+        summary_keys, bigram_owner = _bigram_keys(tokens, token_owner, run, encoding.n_vocab)
+        novel = ~np.isin(summary_keys, source_keys)
+        totals = np.bincount(bigram_owner, minlength=n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            novelty = np.where(totals > 0, np.bincount(bigram_owner, weights=novel, minlength=n) / totals, np.nan)
+
+    valid = (np.abs(word_drift) <= MAX_WORD_DRIFT) & (np.nan_to_num(retention, nan=1.0) >= MIN_RETENTION)
+    return StepMetrics(run, step, len(runs), words=words, tokens=n_tokens, entities=n_entities, word_drift=word_drift,
+                       entity_density=entity_density, retention=retention, novelty=novelty, valid=valid)
+
+
+def score_runs(runs, sources=None, model=TOKEN_MODEL, use_spacy=True, runs_per_batch=RUNS_PER_BATCH):
+    # runs: lists of {"Missing_Entities", "Denser_Summary"} steps; sources: the article of each run
+    entity_fn = text_entities if use_spacy else regex_entities
+    parts = []
+    offsets = []
+    with span("metrics", runs=len(runs)):
+        for start in range(0, len(runs), runs_per_batch):
+            batch_sources = sources[start:start + runs_per_batch] if sources is not None else None
+            parts.append(_score_batch(runs[start:start + runs_per_batch], batch_sources, model, entity_fn))
+            offsets.append(start)
+        if not parts:
+            return _score_batch([], None, model, entity_fn)
+        if len(parts) == 1:
+            return parts[0]
+        return StepMetrics.concatenate(parts, offsets)
+
+
+def score_result(result, article_text=None, use_spacy=None):
+    # A run_cod result with "metrics" per step and the chosen "best_step" added.
+    # use_spacy=None: spaCy when its model is installed, names and numbers otherwise.
+    sources = [article_text] if article_text is not None else None
+    try:
+        scores = score_runs([result["steps"]], sources, use_spacy=use_spacy is not False)
+    except OSError:
+        if use_spacy:
+            raise
+        scores = score_runs([result["steps"]], sources, use_spacy=False)
+    return {**result, "metrics": scores.for_run(0), "best_step": int(scores.best_step[0])}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score the CoD steps of a batch.py results file.")
+    parser.add_argument("results", help="JSONL written by batch.py")
+    parser.add_argument("-o", "--output", help="JSONL with metrics and best_step per document (default: stdout)")
+    parser.add_argument("--sources", action="store_true", help="re-read each PDF to score novelty against it")
+    parser.add_argument("--regex-entities", action="store_true", help="count names and numbers instead of spaCy NER")
+    args = parser.parse_args(argv)
+
+    with open(args.results) as f:
+        records = [record for record in map(json.loads, f) if record.get("status") == "ok" and record["summaries"]]
+    sources = None
+    if args.sources:
+        from cod import MAX_SOURCE_CHARS, read_pdf_path
+        sources = [read_pdf_path(record["path"], MAX_SOURCE_CHARS) for record in records]
+    scores = score_runs([record["summaries"] for record in records], sources, use_spacy=not args.regex_entities)
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    for i, record in enumerate(records):
+        out.write(json.dumps({"path": record["path"], "best_step": int(scores.best_step[i]),
+                              "metrics": scores.for_run(i)}) + "\n")
+    if args.output:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
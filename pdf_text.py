@@ -0,0 +1,133 @@
+import io
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import PyPDF2
+
+from tracing import span
+
+PARALLEL_MIN_PAGES = 64  # smaller files are faster to extract in-process
+PAGES_PER_TASK = 16
+TOKEN_ENCODING = "cl100k_base"
+
+
+def _open_reader(source):
+    # Paths are memory-mapped instead of read into a BytesIO copy
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            stream = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        stream = io.BytesIO(source)
+    return PyPDF2.PdfReader(stream)
+
+
+def iter_pages(source):
+    # One page at a time, so callers can stop as soon as they have enough text
+    pdf_reader = _open_reader(source)
+    for page in pdf_reader.pages:
+        yield page.extract_text() or ""
+
+
+_worker_reader = (None, None)
+UPLOAD_KEY = "<upload>"  # stands in for the path of in-memory PDFs, never a real file name
+
+
+def _init_upload_worker(pdf_bytes):
+    # In-memory PDFs are handed to each worker once, when it starts, not with every task
+    global _worker_reader
+    _worker_reader = (UPLOAD_KEY, _open_reader(pdf_bytes))
+
+
+def _extract_range(path, start, stop):
+    # Runs in a worker process; the reader is kept across tasks for the same file
+    global _worker_reader
+    if _worker_reader[0] != path:
+        _worker_reader = (path, _open_reader(path))
+    pages = _worker_reader[1].pages
+    return [pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def _iter_pages_parallel(source, start, n_pages, workers):
+    # Page ranges are submitted a window at a time and yielded in order;
+    # closing the generator early cancels whatever has not started yet
+    ranges = [(first, min(first + PAGES_PER_TASK, n_pages)) for first in range(start, n_pages, PAGES_PER_TASK)]
+    if isinstance(source, (str, os.PathLike)):
+        path, pool_args = os.fspath(source), {}
+    else:
+        path, pool_args = UPLOAD_KEY, {"initializer": _init_upload_worker, "initargs": (source,)}
+    with ProcessPoolExecutor(max_workers=workers, **pool_args) as pool:
+        pending = []
+        next_range = 0
+        try:
+            while pending or next_range < len(ranges):
+                while next_range < len(ranges) and len(pending) < workers * 2:
+                    first, stop = ranges[next_range]
+                    pending.append(pool.submit(_extract_range, path, first, stop))
+                    next_range += 1
+                for text in pending.pop(0).result():
+                    yield text
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def iter_pages_parallel(source, workers=None):
+    # A path or the PDF bytes. The first pages are read in-process: a small budget is
+    # usually met there and no pool is started. Whatever is left of a large file goes parallel.
+    if workers is None:
+        workers = min(os.cpu_count() or 1, 8)
+    pdf_reader = _open_reader(source)
+    n_pages = len(pdf_reader.pages)
+    head = min(PAGES_PER_TASK, n_pages)
+    for i in range(head):
+        yield pdf_reader.pages[i].extract_text() or ""
+    if workers > 1 and n_pages - head >= PARALLEL_MIN_PAGES:
+        yield from _iter_pages_parallel(source, head, n_pages, workers)
+    else:
+        for i in range(head, n_pages):
+            yield pdf_reader.pages[i].extract_text() or ""
+
+
+class _Budget:
+    def __init__(self, max_chars, max_tokens):
+        self.max_chars = max_chars
+        self.max_tokens = max_tokens
+        self.chars = 0
+        self.tokens = 0
+        if max_tokens is not None:
+            import tiktoken
+            self.encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+
+    def add(self, text):
+        self.chars += len(text)
+        if self.max_tokens is not None:
+            self.tokens += len(self.encoding.encode(text, disallowed_special=()))
+
+    def exhausted(self):
+        if self.max_chars is not None and self.chars >= self.max_chars:
+            return True
+        return self.max_tokens is not None and self.tokens >= self.max_tokens
+
+
+def extract_text(source, max_chars=None, max_tokens=None, workers=None):
+    # source is a file path or the raw PDF bytes. Extraction stops at the first
+    # page that fills the budget; the result is cut to max_chars exactly.
+    pages = iter_pages_parallel(source, workers)
+    budget = _Budget(max_chars, max_tokens)
+    parts = []
+    with span("pdf_extract") as current:
+        try:
+            for text in pages:
+                parts.append(text)
+                budget.add(text)
+                if budget.exhausted():
+                    break
+        finally:
+            pages.close()
+        current.attrs["pages"] = len(parts)
+
+    text = "\n".join(parts)
+    if max_chars is not None:
+        text = text[:max_chars]
+    return text
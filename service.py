@@ -0,0 +1,250 @@
+import argparse
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from urllib.parse import unquote, urlparse
+
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from cod import MAX_SOURCE_CHARS, MODES, STEPS, read_pdf, read_pdf_path, run_cod
+from index_store import pdf_digest
+from tracing import METRICS, start_trace
+
+# Jobs are kept in this process's memory: behind a load balancer, route a job's status and
+# result requests to the instance that accepted it (e.g. sticky sessions on the job id).
+WORKERS = int(os.getenv("COD_WORKERS", 4))  # jobs running at once
+QUEUE_SIZE = int(os.getenv("COD_QUEUE_SIZE", 100))  # jobs waiting; more are refused with 503
+MAX_JOBS = 1000  # finished jobs kept for their results, oldest dropped first
+MAX_UPLOAD_BYTES = 100 * 1024 ** 2
+MAX_STEPS = 10  # densification steps a job may ask for
+# Local files may only be read from below this directory
+FILE_ROOT = os.path.realpath(os.getenv("COD_FILE_ROOT", os.getcwd()))
+
+
+class Job:
+    def __init__(self, mode, model, pdf_bytes=None, path=None, name=None, steps=STEPS):
+        self.id = uuid.uuid4().hex
+        self.mode = mode
+        self.model = model
+        self.steps = steps
+        self.pdf_bytes = pdf_bytes
+        self.path = path
+        self.name = name or (os.path.basename(path) if path else None)
+        self.status = "queued"
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "mode": self.mode,
+            "model": self.model,
+            "steps": self.steps,
+            "name": self.name,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+        }
+
+
+def run_job(job):
+    # read_pdf -> run_cod, the same pipeline as the Streamlit pages
+    with start_trace("service") as trace:
+        # The hierarchical mode is made for whole documents; the others stop early
+        max_chars = None if job.mode == "hierarchical" else MAX_SOURCE_CHARS
+        if job.path is not None:
+            article_text = read_pdf_path(job.path, max_chars=max_chars)
+        else:
+            article_text = read_pdf(job.pdf_bytes, max_chars=max_chars)
+        result = run_cod(article_text, mode=job.mode, model=job.model, steps=job.steps)
+    result["trace"] = trace.totals()
+    return result
+
+
+class JobQueue:
+    # A bounded queue drained by a fixed number of worker threads
+
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE, max_jobs=MAX_JOBS):
+        self.jobs = OrderedDict()
+        self.max_jobs = max_jobs
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work, name=f"cod-worker-{i}", daemon=True)
+                         for i in range(workers)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        # Running jobs finish; queued ones are dropped with the process
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, job):
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise HTTPException(503, "Too many queued jobs, retry later", headers={"Retry-After": "30"})
+        with self._lock:
+            self.jobs[job.id] = job
+            self._forget_old()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            raise HTTPException(404, f"Unknown job {job_id}")
+        return job
+
+    def _forget_old(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished is not None]
+        for job_id in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.status = "running"
+            job.started = time.time()
+            try:
+                job.result = run_job(job)
+                job.status = "done"
+            except Exception as e:
+                job.error = f"{type(e).__name__}: {e}"
+                job.status = "error"
+            finally:
+                job.pdf_bytes = None  # the upload is not needed any more
+                job.finished = time.time()
+                self._queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {"workers": len(self._threads), "queued": self._queue.qsize(), "jobs": counts}
+
+
+def local_path(location):
+    # A plain path or a file:// URL, which must resolve to a PDF below FILE_ROOT
+    parsed = urlparse(location)
+    if parsed.scheme not in ("", "file"):
+        raise HTTPException(400, "Only local files (a path or a file:// URL) can be read")
+    # Relative paths are relative to FILE_ROOT, not to wherever the server was started
+    path = os.path.realpath(os.path.join(FILE_ROOT, unquote(parsed.path) if parsed.scheme else location))
+    if os.path.commonpath([path, FILE_ROOT]) != FILE_ROOT:
+        raise HTTPException(403, f"{location} is outside {FILE_ROOT}")
+    if not os.path.isfile(path):
+        raise HTTPException(404, f"No such file: {location}")
+    return path
+
+
+def check_mode(mode):
+    if mode not in MODES:
+        raise HTTPException(422, f"Unknown mode {mode!r}, expected one of {list(MODES)}")
+    return mode
+
+
+def check_steps(steps):
+    try:
+        steps = int(steps)
+    except (TypeError, ValueError):
+        steps = 0
+    if not 1 <= steps <= MAX_STEPS:
+        raise HTTPException(422, f"steps must be an integer from 1 to {MAX_STEPS}")
+    return steps
+
+
+jobs = JobQueue()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    load_dotenv()
+    jobs.start()
+    yield
+    jobs.stop()
+
+
+app = FastAPI(title="CoD summarization service", lifespan=lifespan)
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(request: Request, mode: str = "single_shot", model: str = None, name: str = None,
+                     steps: int = STEPS):
+    # Either the PDF itself as the body (Content-Type: application/pdf), or
+    # JSON like {"url": "file:///data/paper.pdf", "mode": "iterative"}
+    if request.headers.get("content-type", "").startswith("application/json"):
+        body = await request.json()
+        location = body.get("url") or body.get("path")
+        if not location:
+            raise HTTPException(422, "JSON bodies need a 'url' or 'path'")
+        job = Job(check_mode(body.get("mode", mode)), body.get("model", model), path=local_path(location),
+                  name=body.get("name", name), steps=check_steps(body.get("steps", steps)))
+    else:
+        pdf_bytes = await request.body()
+        if not pdf_bytes:
+            raise HTTPException(422, "Send a PDF as the request body, or JSON with a 'url'")
+        if len(pdf_bytes) > MAX_UPLOAD_BYTES:
+            raise HTTPException(413, f"PDFs are limited to {MAX_UPLOAD_BYTES} bytes")
+        job = Job(check_mode(mode), model, pdf_bytes=pdf_bytes, name=name or pdf_digest(pdf_bytes)[:12],
+                  steps=check_steps(steps))
+    jobs.submit(job)
+    return JSONResponse(job.to_dict(), status_code=202, headers={"Location": f"/jobs/{job.id}"})
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    return jobs.get(job_id).to_dict()
+
+
+@app.get("/jobs/{job_id}/result")
+def job_result(job_id: str):
+    job = jobs.get(job_id)
+    if job.status == "done":
+        return {**job.to_dict(), "result": job.result}
+    if job.status == "error":
+        return JSONResponse(job.to_dict(), status_code=500)
+    # Not finished yet; poll again
+    return JSONResponse(job.to_dict(), status_code=202, headers={"Retry-After": "5"})
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok", **jobs.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return METRICS.prometheus_text()
+
+
+def main(argv=None):
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve CoD summarization over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+SAMPLE_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "doc", "SSRN-id4573321.pdf")
+
+# Dependencies that take most of a second or more to import. Modules marked light below
+# must import without any of them; they are loaded by the first code path that needs them.
+HEAVY = ["spacy", "langchain", "chromadb", "openai", "aiohttp", "duckdb", "hnswlib"]
+
+IMPORT_BUDGET = 1.5  # seconds per module, in a fresh interpreter
+INTERACTION_BUDGET = 5.0  # seconds for the first call after the import
+
+
+def _sample_bytes():
+    with open(SAMPLE_PDF, "rb") as f:
+        return f.read()
+
+
+def _first_extract():
+    from pdf_text import extract_text
+    extract_text(_sample_bytes(), max_chars=100000)
+
+
+def _first_ner():
+    from entities import build_entity_index
+    build_entity_index("Apple bought Shazam in London for $400 million, Tim Cook said on Monday.")
+
+
+def _first_cod():
+    from cod import run_cod
+    from fake_openai import OfflineOpenAI
+    # The offline block swaps in empty throwaway caches: nothing is answered from, or
+    # written to, the user's response cache
+    with OfflineOpenAI():
+        run_cod("The Federal Reserve raised rates in March. " * 50, mode="single_shot")
+
+
+def _first_upload():
+    from streamlit_cache import file_hash, load_document_text, split_documents
+    pdf_bytes = _sample_bytes()
+    split_documents(load_document_text(file_hash(pdf_bytes), pdf_bytes, "sample.pdf"))
+
+
+# module -> (first interaction, must import without HEAVY dependencies)
+MODULES = {
+    "pdf_text": (_first_extract, True),
+    "entities": (_first_ner, True),
+    "cod": (_first_cod, True),
+    "streamlit_cache": (_first_upload, True),
+    "app": (None, True),  # importing a page runs it once, up to the upload widget
+    "codapp": (None, True),
+    "batch": (None, False),
+}
+
+
+def measure(module):
+    # Runs in a fresh interpreter, see run_child
+    interaction, _ = MODULES[module]
+    start = time.perf_counter()
+    __import__(module)
+    result = {
+        "import_s": time.perf_counter() - start,
+        "heavy_loaded": [name for name in HEAVY if name in sys.modules],
+    }
+    if interaction is not None:
+        start = time.perf_counter()
+        try:
+            interaction()
+            result["first_call_s"] = time.perf_counter() - start
+        except Exception as e:
+            # e.g. no spaCy model or tiktoken encoding on an offline machine
+            result["skipped"] = f"{type(e).__name__}: {e}"[:200]
+    return result
+
+
+def run_child(module):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", module],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if output.returncode != 0:
+        return {"error": output.stderr.strip().splitlines()[-1] if output.stderr.strip() else "failed"}
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def summarize(runs):
+    # Median over fresh processes; the OS file cache is warm after the first one
+    failed = [run for run in runs if "error" in run]
+    if failed:
+        return failed[-1]
+    result = {
+        "import_s": round(statistics.median(run["import_s"] for run in runs), 4),
+        "heavy_loaded": runs[-1]["heavy_loaded"],
+    }
+    first_calls = [run["first_call_s"] for run in runs if "first_call_s" in run]
+    if first_calls:
+        result["first_call_s"] = round(statistics.median(first_calls), 4)
+    elif "skipped" in runs[-1]:
+        result["skipped"] = runs[-1]["skipped"]
+    return result
+
+
+def check(report, import_budget, interaction_budget, allow_skips=False):
+    failures = []
+    for module, result in report["modules"].items():
+        if "error" in result:
+            failures.append(f"{module}: import failed ({result['error']})")
+            continue
+        if result["import_s"] > import_budget:
+            failures.append(f"{module}: import {result['import_s']}s > {import_budget}s")
+        if "skipped" in result and not allow_skips:
+            # An interaction that could not run has not met its budget
+            failures.append(f"{module}: first call skipped ({result['skipped']})")
+        if result.get("first_call_s", 0) > interaction_budget:
+            failures.append(f"{module}: first call {result['first_call_s']}s > {interaction_budget}s")
+        if MODULES[module][1] and result["heavy_loaded"]:
+            failures.append(f"{module}: imports {', '.join(result['heavy_loaded'])} at startup")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure import time and first-call latency of each CoD module in fresh interpreters. "
+                    "Exits 1 when a module is over budget, pulls in a heavy dependency at import, "
+                    "or its first call could not be measured."
+    )
+    parser.add_argument("modules", nargs="*", default=list(MODULES), help=f"default: {' '.join(MODULES)}")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET)
+    parser.add_argument("--interaction-budget", type=float, default=INTERACTION_BUDGET)
+    parser.add_argument("--allow-skips", action="store_true",
+                        help="pass modules whose first call could not run (e.g. no spaCy model or tokenizer files)")
+    parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(measure(args.child)))
+        return
+    unknown = [module for module in args.modules if module not in MODULES]
+    if unknown:
+        parser.error(f"unknown modules: {', '.join(unknown)}")
+
+    report = {"python": platform.python_version(), "platform": platform.platform(), "repeat": args.repeat,
+              "modules": {}}
+    for module in args.modules:
+        report["modules"][module] = summarize([run_child(module) for _ in range(args.repeat)])
+        print(f"{module}: {report['modules'][module]}", file=sys.stderr)
+
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(payload + "\n")
+    else:
+        print(payload)
+
+    failures = check(report, args.import_budget, args.interaction_budget, args.allow_skips)
+    for failure in failures:
+        print(f"OVER BUDGET {failure}", file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import streamlit as st
+
+from chunking import CHUNK_OVERLAP, CHUNK_TOKENS, DocumentText, TokenChunks
+from cod import read_pdf
+from context import article_entity_index
+from index_store import MAX_OPEN, collection_key, default_store, pdf_digest
+from pdf_text import iter_pages_parallel
+from tracing import span
+
+# Streamlit re-runs the whole page on every interaction. Everything derived from
+# an upload is cached here under the file's hash, so reruns reuse it. Arguments
+# starting with an underscore are not hashed by Streamlit; the hash stands in.
+# The spaCy model is already loaded once per process by entities.load_nlp.
+# langchain takes seconds to import, so it is only imported once a file is processed.
+
+def file_hash(pdf_bytes):
+    return pdf_digest(pdf_bytes)
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def load_document_text(pdf_hash, _pdf_bytes, source_name):
+    # All pages as one string with page offsets, for the chunker and the CoD context
+    with span("pdf_load"):
+        return DocumentText(iter_pages_parallel(_pdf_bytes), source_name)
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def load_text(pdf_hash, _pdf_bytes, max_chars, max_tokens=None):
+    return read_pdf(_pdf_bytes, max_chars=max_chars, max_tokens=max_tokens)
+
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def get_entity_index(pdf_hash, _text):
+    # spaCy over the whole article takes seconds on a long report; parsed once per file,
+    # not on every click or slider change. None when no spaCy model is installed.
+    return article_entity_index(_text)
+
+
+@st.cache_resource(show_spinner=False)
+def get_embeddings():
+    from langchain.embeddings.openai import OpenAIEmbeddings
+
+    from embedding_cache import CachedEmbeddings
+    return CachedEmbeddings(OpenAIEmbeddings())
+
+
+def split_documents(document):
+    # Chunk texts are only sliced out of the document here, for embedding
+    return TokenChunks(document, CHUNK_TOKENS, CHUNK_OVERLAP).documents()
+
+
+@st.cache_resource(max_entries=MAX_OPEN, show_spinner=False)
+def get_retriever(pdf_hash, _document):
+    # Kept to the index store's open-collection budget, so memory stays bounded
+    embeddings = get_embeddings()
+    key = collection_key(pdf_hash, CHUNK_TOKENS, CHUNK_OVERLAP, embeddings.model)
+    vectordb = default_store().get_or_create(key, lambda: split_documents(_document), embeddings)
+    return vectordb.as_retriever()
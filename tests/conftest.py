@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+import tiktoken
+
+# The modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def byte_encoding():
+    # One token per UTF-8 byte, so no tokenizer files have to be downloaded
+    return tiktoken.Encoding(
+        "bytes",
+        pat_str=r"\S+|\s+",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={},
+    )
@@ -0,0 +1,92 @@
+import pytest
+
+import context
+from chunking import DocumentText, TokenChunks
+from context import token_chunks, token_offsets
+
+TEXT = "Zürich — naïve café, 東京 and 🙂 emoji. " * 12
+
+
+@pytest.fixture(autouse=True)
+def offline_tokenizer(monkeypatch, byte_encoding):
+    monkeypatch.setattr(context, "get_encoding", lambda model: byte_encoding)
+    context._tokenize.cache_clear()
+    yield
+    context._tokenize.cache_clear()
+
+
+def _char_of_byte(text):
+    # Character index of every UTF-8 byte, one character at a time
+    chars = []
+    for i, ch in enumerate(text):
+        chars.extend([i] * len(ch.encode("utf-8")))
+    return chars
+
+
+def test_offsets_map_bytes_to_characters(byte_encoding):
+    tokens, offsets = token_offsets(TEXT, byte_encoding)
+    assert tokens.tolist() == list(TEXT.encode("utf-8"))
+    assert offsets.tolist() == _char_of_byte(TEXT)
+
+
+def test_offsets_of_empty_text(byte_encoding):
+    tokens, offsets = token_offsets("", byte_encoding)
+    assert len(tokens) == 0 and len(offsets) == 0
+
+
+def test_token_chunks_cover_text_without_overlap():
+    chunks = token_chunks(TEXT, "model", 50)
+    assert "".join(TEXT[c.start:c.end] for c in chunks) == TEXT
+    assert sum(c.n_tokens for c in chunks) == len(TEXT.encode("utf-8"))
+    assert chunks[-1].end == len(TEXT)
+
+
+@pytest.mark.parametrize("chunk_tokens,chunk_overlap", [(50, 0), (50, 10), (64, 63), (1000, 150)])
+def test_window_layout(chunk_tokens, chunk_overlap):
+    chunks = TokenChunks(DocumentText([TEXT]), chunk_tokens, chunk_overlap, model="model")
+    n = len(TEXT.encode("utf-8"))
+    first, last = chunks.first_token, chunks.last_token
+    assert first[0] == 0 and last[-1] == n
+    assert (first[1:] == first[:-1] + chunk_tokens - chunk_overlap).all()
+    assert (last - first <= chunk_tokens).all()
+    # The last window is the only one to reach the end, so none lies inside the one before
+    assert (last[:-1] < n).all()
+    assert chunks.ends[-1] == len(TEXT)
+    offsets = _char_of_byte(TEXT) + [len(TEXT)]
+    for i in range(len(chunks)):
+        assert chunks[i] == TEXT[offsets[first[i]]:offsets[last[i]]]
+        assert chunks.n_tokens(i) == last[i] - first[i]
+
+
+def test_overlap_must_be_smaller_than_chunk():
+    with pytest.raises(ValueError):
+        TokenChunks(DocumentText([TEXT]), 10, 10, model="model")
+
+
+def test_page_provenance():
+    pages = ["first page " * 5, "second page " * 5, "third " * 5]
+    document = DocumentText(pages, source="doc.pdf")
+    assert document.text == " ".join(pages)
+    chunks = TokenChunks(document, 40, 8, model="model")
+    starts = [document.text.index(page) for page in pages]
+    for i in range(len(chunks)):
+        metadata = chunks.metadata(i)
+        assert metadata["source"] == "doc.pdf"
+        assert metadata["page"] == max(p for p, start in enumerate(starts) if start <= metadata["start"])
+        assert metadata["last_page"] == max(p for p, start in enumerate(starts) if start < metadata["end"])
+    assert chunks.metadata(0)["page"] == 0
+    assert chunks.metadata(len(chunks) - 1)["last_page"] == len(pages) - 1
+
+
+def test_empty_document():
+    chunks = TokenChunks(DocumentText([]), model="model")
+    assert len(chunks) == 0
+    assert chunks.texts() == [] and chunks.metadatas() == []
+    assert token_chunks("", "model") == []
+
+
+def test_tokenization_is_shared():
+    document = DocumentText([TEXT])
+    TokenChunks(document, model="model")
+    token_chunks(document.text, "other-model")
+    assert context._tokenize.cache_info().hits == 1
@@ -0,0 +1,124 @@
+import json
+
+import pytest
+
+from cod_json import SchemaError, StepStreamParser, parse_cod_json, repair_json
+
+STEPS = [
+    {"Missing_Entities": "Apple; Shazam", "Denser_Summary": "Apple bought Shazam."},
+    {"Missing_Entities": "London", "Denser_Summary": "Apple bought London's Shazam."},
+]
+
+
+def test_strict_json_is_normalized():
+    steps = parse_cod_json(json.dumps(STEPS))
+    assert steps[0] == {"Missing_Entities": ["Apple", "Shazam"], "Denser_Summary": "Apple bought Shazam."}
+    assert steps[1]["Missing_Entities"] == ["London"]
+
+
+def test_fences_prose_and_trailing_commas():
+    text = 'Here you go:\n```json\n[{"Missing_Entities": "A", "Denser_Summary": "s1",},]\n```\nHope it helps!'
+    assert parse_cod_json(text) == [{"Missing_Entities": ["A"], "Denser_Summary": "s1"}]
+
+
+def test_missing_comma_between_objects():
+    text = '[{"Missing_Entities": "A", "Denser_Summary": "s1"} {"Missing_Entities": "B", "Denser_Summary": "s2"}]'
+    assert [step["Denser_Summary"] for step in parse_cod_json(text)] == ["s1", "s2"]
+
+
+def test_commas_and_brackets_inside_strings_are_left_alone():
+    summary = 'He said "a, b}" and [c],'
+    text = json.dumps([{"Missing_Entities": "A", "Denser_Summary": summary}])
+    assert json.loads(repair_json(text))[0]["Denser_Summary"] == summary
+
+
+def test_cut_off_string_is_dropped_with_its_key():
+    text = '[{"Missing_Entities": "A", "Denser_Summary": "s1"}, {"Missing_Entities": "B", "Denser_Summary": "half wri'
+    assert json.loads(repair_json(text)) == [
+        {"Missing_Entities": "A", "Denser_Summary": "s1"},
+        {"Missing_Entities": "B"},
+    ]
+    # The second step has no summary left, so only the first survives
+    assert parse_cod_json(text) == [{"Missing_Entities": ["A"], "Denser_Summary": "s1"}]
+
+
+def test_raw_newlines_inside_strings():
+    text = '[{"Missing_Entities": "A", "Denser_Summary": "line\nbreak"}]'
+    assert parse_cod_json(text) == [{"Missing_Entities": ["A"], "Denser_Summary": "line\nbreak"}]
+    # Also when the rest of the answer needs repairing
+    assert parse_cod_json(text[:-1] + ",") == parse_cod_json(text)
+
+
+def test_objects_without_an_enclosing_list_are_all_kept():
+    text = "\n".join(json.dumps(step) for step in STEPS) + "\nThat is all {really}."
+    assert parse_cod_json(text) == parse_cod_json(json.dumps(STEPS))
+    # A cut-off last object is closed like any other
+    assert json.loads(repair_json(text[:text.rindex('"Denser_Summary"')])) == [STEPS[0], {"Missing_Entities": "London"}]
+
+
+def test_prose_after_a_single_object_is_ignored():
+    text = json.dumps(STEPS[0]) + " Note: {see above}"
+    assert json.loads(repair_json(text)) == STEPS[0]
+
+
+def test_key_spelling_and_wrappers():
+    text = json.dumps({"summaries": [{"missing entities": ["A"], "DenserSummary": " s1 "}]})
+    assert parse_cod_json(text) == [{"Missing_Entities": ["A"], "Denser_Summary": "s1"}]
+
+
+def test_invalid_steps_are_skipped_but_one_must_survive():
+    text = json.dumps([{"Denser_Summary": ""}, {"Missing_Entities": "A", "Denser_Summary": "ok"}])
+    assert parse_cod_json(text) == [{"Missing_Entities": ["A"], "Denser_Summary": "ok"}]
+    with pytest.raises(SchemaError):
+        parse_cod_json(json.dumps([{"Denser_Summary": ""}]))
+    with pytest.raises(SchemaError):
+        parse_cod_json("no JSON here")
+
+
+@pytest.mark.parametrize("piece", [1, 3, 16])
+def test_stream_parser_returns_each_step_once_as_it_closes(piece):
+    text = json.dumps({"steps": STEPS})
+    parser = StepStreamParser()
+    seen = []
+    for i in range(0, len(text), piece):
+        seen.extend(parser.feed(text[i:i + piece]))
+    seen.extend(parser.close())
+    assert seen == parse_cod_json(text)
+    assert parser.steps == seen
+    assert parser.errors == []
+
+
+def test_stream_parser_ignores_braces_and_escaped_quotes_in_strings():
+    summary = 'A "quoted \\"}{\\" brace" here'
+    text = json.dumps([{"Missing_Entities": "A", "Denser_Summary": summary}])
+    parser = StepStreamParser()
+    steps = parser.feed(text)
+    assert [step["Denser_Summary"] for step in steps] == [summary]
+
+
+def test_stream_parser_recovers_a_truncated_last_step():
+    text = json.dumps(STEPS)
+    truncated = text[:text.rindex('"Denser_Summary"')] + '"Denser_Summary": "cut off'
+    parser = StepStreamParser()
+    assert len(parser.feed(truncated[:text.index("}") + 1])) == 1
+    parser.feed(truncated[text.index("}") + 1:])
+    # The cut-off summary is dropped with its key, so the last step is not recoverable
+    with pytest.raises(SchemaError):
+        StepStreamParser().close()
+    assert parser.close() == []
+    assert len(parser.steps) == 1
+
+
+def test_stream_parser_recovers_last_step_missing_its_closing_brace():
+    text = json.dumps(STEPS)[:-2]  # no "}]"
+    parser = StepStreamParser()
+    parser.feed(text)
+    assert parser.close() == [parse_cod_json(json.dumps(STEPS))[1]]
+    assert len(parser.steps) == 2
+
+
+def test_stream_parser_accepts_raw_newlines_inside_strings():
+    parser = StepStreamParser()
+    steps = parser.feed('[{"Missing_Entities": "A", "Denser_Summary": "line\nbreak"}')
+    assert [step["Denser_Summary"] for step in steps] == ["line\nbreak"]
+    assert parser.errors == []
@@ -0,0 +1,102 @@
+import pytest
+
+import densify
+from densify import (DENSITY_PLATEAU, LATENCY_BUDGET, MAX_STEPS, NO_MISSING_ENTITIES, TOKEN_BUDGET,
+                     StopController)
+
+MISSING = ["Apple"]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # A perf_counter that only moves when the test says so
+    now = [100.0]
+    monkeypatch.setattr(densify.time, "perf_counter", lambda: now[0])
+    return now
+
+
+def test_first_round_always_runs(clock):
+    controller = StopController(3, max_seconds=0, max_tokens=0)
+    assert not controller.should_stop([], 0)
+    assert controller.stop_reason is None
+
+
+def test_max_steps(clock):
+    controller = StopController(2)
+    for density in (0.1, 0.2):
+        assert not controller.should_stop(MISSING, 0)
+        controller.record(density, 1.0, 100)
+    assert controller.should_stop(MISSING, 0)
+    assert controller.stop_reason == MAX_STEPS
+
+
+def test_no_missing_entities(clock):
+    controller = StopController(5)
+    controller.record(0.1, 1.0, 100)
+    assert controller.should_stop([], 100)
+    assert controller.stop_reason == NO_MISSING_ENTITIES
+
+
+@pytest.mark.parametrize("densities,patience,stops", [
+    ([0.10, 0.12], 1, False),  # gained more than MIN_DENSITY_GAIN
+    ([0.10, 0.102], 1, True),  # gained less
+    ([0.10, 0.09], 1, True),  # got sparser
+    ([0.10, 0.102], 2, False),  # one stalled round is within patience
+    ([0.10, 0.102, 0.103], 2, True),
+    ([0.10, 0.102, 0.12, 0.121], 2, False),  # progress resets the count
+])
+def test_density_plateau(clock, densities, patience, stops):
+    controller = StopController(10, patience=patience)
+    for density in densities:
+        controller.record(density, 1.0, 100)
+    assert controller.should_stop(MISSING, 0) == stops
+    assert controller.stop_reason == (DENSITY_PLATEAU if stops else None)
+
+
+def test_latency_budget_stops_before_the_round_that_would_overrun(clock):
+    controller = StopController(10, max_seconds=10)
+    clock[0] += 4
+    controller.record(0.1, 4.0, 100)
+    # 4s spent plus an average round of 4s fits in 10s
+    assert not controller.should_stop(MISSING, 100)
+    clock[0] += 2
+    controller.record(0.2, 2.0, 100)
+    # 6s spent plus an average round of 3s fits
+    assert not controller.should_stop(MISSING, 200)
+    # 7.5s spent plus 3s does not
+    clock[0] += 1.5
+    assert controller.should_stop(MISSING, 200)
+    assert controller.stop_reason == LATENCY_BUDGET
+
+
+def test_token_budget_stops_before_the_round_that_would_overrun(clock):
+    controller = StopController(10, max_tokens=1000)
+    controller.record(0.1, 1.0, 300)
+    controller.record(0.2, 1.0, 500)
+    # 800 used plus an average round of 400 is over 1000
+    assert controller.should_stop(MISSING, 800)
+    assert controller.stop_reason == TOKEN_BUDGET
+    assert not StopController(10, max_tokens=1200).should_stop(MISSING, 800)
+
+
+def test_reasons_are_checked_in_order(clock):
+    # Out of steps and out of entities: the step count is reported
+    controller = StopController(1, max_tokens=1)
+    controller.record(0.1, 1.0, 100)
+    assert controller.should_stop([], 100)
+    assert controller.stop_reason == MAX_STEPS
+    # A plateau is reported before a budget
+    controller = StopController(10, max_tokens=1)
+    controller.record(0.1, 1.0, 100)
+    controller.record(0.1, 1.0, 100)
+    assert controller.should_stop(MISSING, 200)
+    assert controller.stop_reason == DENSITY_PLATEAU
+
+
+def test_record_keeps_the_history(clock):
+    controller = StopController(5)
+    controller.record(0.1, 1.5, 120)
+    controller.record(0.2, 2.5, 80)
+    assert controller.densities == [0.1, 0.2]
+    assert controller.step_seconds == [1.5, 2.5]
+    assert controller.step_tokens == [120, 80]
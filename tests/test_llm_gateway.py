@@ -0,0 +1,248 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+
+import openai
+import pytest
+
+import llm_gateway
+from llm_gateway import LLMGateway, TokenBucket
+
+PARAMS = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "Summarize."}], "max_tokens": 100}
+
+
+def _response(text="ok"):
+    return {"choices": [{"message": {"content": text}}], "usage": {"prompt_tokens": 10, "completion_tokens": 5,
+                                                                   "total_tokens": 15}}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # monotonic for the buckets, and a sleep that only moves it and records how long
+    now = [1000.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(llm_gateway.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(llm_gateway.time, "sleep", sleep)
+    return now, sleeps
+
+
+@pytest.fixture
+def spans(monkeypatch):
+    names = []
+    real_span = llm_gateway.span
+
+    @contextmanager
+    def recording_span(name, **attrs):
+        names.append(name)
+        with real_span(name, **attrs) as current:
+            yield current
+
+    monkeypatch.setattr(llm_gateway, "span", recording_span)
+    return names
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    # openai.ChatCompletion.create / acreate answer from a list of responses and errors
+    monkeypatch.setattr(openai, "api_key", "sk-test")
+    monkeypatch.setattr(openai, "requestssession", None)
+    calls = []
+    answers = []
+    pass_turn = asyncio.sleep  # tests may replace asyncio.sleep
+
+    def create(**params):
+        calls.append(params)
+        answer = answers.pop(0) if answers else _response()
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    async def acreate(**params):
+        # Yields once, as a real request would, so that concurrent callers overlap
+        await pass_turn(0)
+        return create(**params)
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", staticmethod(create))
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", staticmethod(acreate))
+    return calls, answers
+
+
+def test_bucket_goes_into_debt_and_refills(clock):
+    now, _ = clock
+    bucket = TokenBucket(60)  # one per second
+    assert bucket.reserve(60) == 0
+    # Empty: the next one waits a second, the one after it two
+    assert bucket.reserve(1) == pytest.approx(1)
+    assert bucket.reserve(1) == pytest.approx(2)
+    now[0] += 2
+    assert bucket.reserve(1) == pytest.approx(1)
+    # Refills to capacity, not beyond
+    now[0] += 3600
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(1) == pytest.approx(1)
+
+
+def test_bucket_caps_requests_at_capacity_and_takes_refunds(clock):
+    bucket = TokenBucket(60)
+    # Larger than a minute's worth would never fit; it takes the whole bucket instead
+    assert bucket.reserve(600) == 0
+    assert bucket.reserve(30) == pytest.approx(30)
+    bucket.refund(30)
+    assert bucket.reserve(1) == pytest.approx(1)
+    bucket.refund(-30)
+    assert bucket.reserve(1) == pytest.approx(32)
+
+
+def test_rate_limits_are_waited_out_before_calling(clock, upstream, monkeypatch):
+    _, sleeps = clock
+    calls, _ = upstream
+    monkeypatch.setitem(llm_gateway.LIMITS, "test-model", (60, 1000000))
+    gateway = LLMGateway()
+    for _ in range(61):
+        gateway.create(**dict(PARAMS, model="test-model"))
+    assert len(calls) == 61
+    assert sleeps == [pytest.approx(1)]
+
+
+def test_rate_limit_error_is_retried_after_retry_after(clock, upstream, spans):
+    _, sleeps = clock
+    calls, answers = upstream
+    answers.extend([openai.error.RateLimitError("slow down", headers={"retry-after": "7"}), _response("second")])
+    gateway = LLMGateway(base_delay=0.01)
+    response = gateway.create(**PARAMS)
+    assert response["choices"][0]["message"]["content"] == "second"
+    assert len(calls) == 2
+    assert sleeps == [7.0]
+    assert spans.count("retry") == 1
+
+
+def test_retries_back_off_and_give_up(clock, upstream):
+    _, sleeps = clock
+    calls, answers = upstream
+    answers.extend(openai.error.APIError("boom", http_status=502) for _ in range(4))
+    gateway = LLMGateway(max_retries=3, base_delay=1, max_delay=3)
+    with pytest.raises(openai.error.APIError):
+        gateway.create(**PARAMS)
+    assert len(calls) == 4
+    assert len(sleeps) == 3
+    assert all(0 <= delay <= limit for delay, limit in zip(sleeps, [1, 2, 3]))
+
+
+@pytest.mark.parametrize("error", [
+    openai.error.InvalidRequestError("bad request", None, http_status=400),
+    openai.error.AuthenticationError("bad key", http_status=401),
+    openai.error.APIError("not found", http_status=404),
+])
+def test_client_errors_are_not_retried(clock, upstream, error):
+    _, sleeps = clock
+    calls, answers = upstream
+    answers.append(error)
+    with pytest.raises(type(error)):
+        LLMGateway().create(**PARAMS)
+    assert len(calls) == 1
+    assert sleeps == []
+
+
+def test_async_retry_honors_retry_after(upstream, monkeypatch):
+    calls, answers = upstream
+    answers.extend([openai.error.RateLimitError("slow down", headers={"retry-after": "2"}), _response()])
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+
+    monkeypatch.setattr(llm_gateway.asyncio, "sleep", sleep)
+    asyncio.run(LLMGateway(base_delay=0.01).acreate(**PARAMS))
+    assert len(calls) == 2
+    assert sleeps == [2.0]
+
+
+def _run_concurrently(gateway, n, spans, release):
+    # n threads ask for the same key; the upstream call is held until the n - 1
+    # followers are waiting on it
+    results = [None] * n
+
+    def worker(i):
+        try:
+            results[i] = gateway.create(key="same", **PARAMS)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    while spans.count("dedup_wait") < n - 1:
+        threading.Event().wait(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+@pytest.fixture
+def held_upstream(upstream, monkeypatch):
+    # Like upstream, but every call blocks until release is set
+    calls, answers = upstream
+    release = threading.Event()
+    create = openai.ChatCompletion.create
+
+    def held_create(**params):
+        assert release.wait(5)
+        return create(**params)
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", staticmethod(held_create))
+    return calls, answers, release
+
+
+def test_concurrent_identical_keys_share_one_call(held_upstream, spans):
+    calls, _, release = held_upstream
+    gateway = LLMGateway()
+    results = _run_concurrently(gateway, 4, spans, release)
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert gateway._inflight == {}
+    # Once the call is over, the same key goes upstream again
+    gateway.create(key="same", **PARAMS)
+    assert len(calls) == 2
+
+
+def test_errors_reach_every_waiter(held_upstream, spans):
+    calls, answers, release = held_upstream
+    error = openai.error.InvalidRequestError("bad request", None, http_status=400)
+    answers.append(error)
+    gateway = LLMGateway()
+    results = _run_concurrently(gateway, 3, spans, release)
+    assert len(calls) == 1
+    assert all(result is error for result in results)
+    assert gateway._inflight == {}
+
+
+def test_async_identical_keys_share_one_call_and_its_error(upstream):
+    calls, answers = upstream
+    gateway = LLMGateway()
+
+    async def main():
+        responses = await asyncio.gather(*(gateway.acreate(key="same", **PARAMS) for _ in range(3)))
+        answers.append(openai.error.InvalidRequestError("bad request", None, http_status=400))
+        errors = await asyncio.gather(*(gateway.acreate(key="other", **PARAMS) for _ in range(3)),
+                                      return_exceptions=True)
+        return responses, errors
+
+    responses, errors = asyncio.run(main())
+    assert len(calls) == 2
+    assert all(response is responses[0] for response in responses)
+    assert all(isinstance(error, openai.error.InvalidRequestError) for error in errors)
+    assert gateway._ainflight == {}
+
+
+def test_calls_without_a_key_are_not_shared(upstream):
+    calls, _ = upstream
+    gateway = LLMGateway()
+    gateway.create(**PARAMS)
+    gateway.create(**PARAMS)
+    assert len(calls) == 2
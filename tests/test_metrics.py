@@ -0,0 +1,124 @@
+import random
+
+import numpy as np
+import pytest
+
+import metrics
+from metrics import MAX_WORD_DRIFT, MIN_RETENTION, TARGET_DENSITY, best_steps, regex_entities, score_result, score_runs
+
+WORDS = ["the", "deal", "closed", "in", "Apple", "Shazam", "London", "Zürich", "2020", "$400", "Tim Cook", "said"]
+
+
+@pytest.fixture(autouse=True)
+def offline_tokenizer(monkeypatch, byte_encoding):
+    monkeypatch.setattr(metrics, "get_encoding", lambda model: byte_encoding)
+
+
+def _bigrams(tokens):
+    return list(zip(tokens, tokens[1:]))
+
+
+def _expected(steps, source, encoding):
+    # The same metrics, one step at a time in plain Python
+    rows = []
+    first_words = None
+    previous = None
+    for step in steps:
+        text = step["Denser_Summary"]
+        words = len(text.split())
+        first_words = words if first_words is None else first_words
+        tokens = encoding.encode_ordinary(text)
+        entities = regex_entities([text])[0]
+        retention = None
+        if previous is not None:
+            retention = len(previous & entities) / len(previous) if previous else 1.0
+        novelty = None
+        if source is not None and len(tokens) > 1:
+            source_bigrams = set(_bigrams(encoding.encode_ordinary(source)))
+            bigrams = _bigrams(tokens)
+            novelty = sum(bigram not in source_bigrams for bigram in bigrams) / len(bigrams)
+        drift = (words - first_words) / max(first_words, 1)
+        rows.append({
+            "words": words,
+            "tokens": len(tokens),
+            "entities": len(entities),
+            "word_drift": drift,
+            "entity_density": len(entities) / max(len(tokens), 1),
+            "retention": retention,
+            "novelty": novelty,
+            "valid": abs(drift) <= MAX_WORD_DRIFT and (retention is None or retention >= MIN_RETENTION),
+        })
+        previous = entities
+    return rows
+
+
+def _expected_best(rows):
+    if not rows:
+        return -1
+    return min(range(len(rows)), key=lambda i: (not rows[i]["valid"],
+                                                abs(rows[i]["entity_density"] - TARGET_DENSITY), i))
+
+
+def _random_runs(n_runs, seed=0):
+    rng = random.Random(seed)
+    runs, sources = [], []
+    for _ in range(n_runs):
+        steps = [{"Missing_Entities": [], "Denser_Summary": " ".join(rng.choices(WORDS, k=rng.randint(1, 12)))}
+                 for _ in range(rng.randint(0, 5))]
+        runs.append(steps)
+        sources.append(" ".join(rng.choices(WORDS, k=40)))
+    return runs, sources
+
+
+def _assert_rows(actual, expected):
+    assert len(actual) == len(expected)
+    for got, want in zip(actual, expected):
+        for name, value in want.items():
+            if value is None or isinstance(value, bool):
+                assert got[name] == value, name
+            else:
+                assert got[name] == pytest.approx(value, abs=1e-4), name
+
+
+@pytest.mark.parametrize("runs_per_batch", [1, 3, 512])
+def test_vectorized_metrics_match_a_step_by_step_computation(byte_encoding, runs_per_batch):
+    runs, sources = _random_runs(25)
+    scores = score_runs(runs, sources, use_spacy=False, runs_per_batch=runs_per_batch)
+    assert len(scores.best_step) == len(runs)
+    for i, (steps, source) in enumerate(zip(runs, sources)):
+        expected = _expected(steps, source, byte_encoding)
+        _assert_rows(scores.for_run(i), expected)
+        assert scores.best_step[i] == _expected_best(expected)
+
+
+def test_without_sources_novelty_is_none(byte_encoding):
+    runs, _ = _random_runs(5, seed=1)
+    scores = score_runs(runs, use_spacy=False)
+    for i, steps in enumerate(runs):
+        _assert_rows(scores.for_run(i), _expected(steps, None, byte_encoding))
+
+
+def test_retention_counts_entities_kept_from_the_previous_step():
+    steps = [
+        {"Missing_Entities": [], "Denser_Summary": "Apple met Shazam in London"},
+        {"Missing_Entities": [], "Denser_Summary": "Apple met Shazam near Paris"},  # London dropped
+        {"Missing_Entities": [], "Denser_Summary": "Apple met Shazam near Paris"},
+    ]
+    result = score_result({"steps": steps}, use_spacy=False)
+    assert [row["retention"] for row in result["metrics"]] == [None, pytest.approx(2 / 3, abs=1e-4), 1.0]
+    assert [row["valid"] for row in result["metrics"]] == [True, False, True]
+
+
+def test_best_steps_prefers_valid_then_target_density_then_earliest():
+    run = np.array([0, 0, 0, 1, 1, 3])
+    step = np.array([0, 1, 2, 0, 1, 0])
+    density = np.array([0.15, 0.15, 0.16, 0.15, 0.30, 0.5])
+    valid = np.array([False, True, True, True, True, False])
+    # run 0: step 0 is closest but invalid; run 1: tie broken by density; run 2: no steps
+    assert best_steps(run, step, density, valid, 4).tolist() == [1, 0, -1, 0]
+
+
+def test_empty_input():
+    scores = score_runs([], use_spacy=False)
+    assert len(scores.best_step) == 0
+    assert score_result({"steps": []}, "source", use_spacy=False)["best_step"] == -1
@@ -0,0 +1,249 @@
+import contextvars
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+
+# USD per 1K tokens (prompt, completion), matched on the longest model prefix
+PRICES = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "text-embedding-ada-002": (0.0001, 0.0),
+}
+
+# When set, every finished trace is appended to this file as JSON lines
+TRACE_LOG = os.getenv("COD_TRACE_LOG")
+
+_current_trace = contextvars.ContextVar("cod_trace", default=None)
+_current_span = contextvars.ContextVar("cod_span", default=None)
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    matches = [name for name in PRICES if model and model.startswith(name)]
+    if not matches:
+        return 0.0
+    prompt_price, completion_price = PRICES[max(matches, key=len)]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+def process_peak_rss_bytes():
+    # The process's high-water mark since it started; never goes down
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def rss_bytes():
+    # Resident memory right now; None where /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Span:
+    def __init__(self, name, parent, attrs):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.start = time.time()
+        self.seconds = None
+        # Memory of this stage: resident memory gained (freed memory makes it negative), and
+        # the most Python/NumPy memory allocated at once, which needs tracemalloc tracing
+        # (python -X tracemalloc or PYTHONTRACEMALLOC=1; benchmark.py starts it)
+        self.rss_delta_bytes = None
+        self.peak_alloc_bytes = None
+        self._child_peak = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost_usd = 0.0
+
+    def add_usage(self, model, prompt_tokens, completion_tokens):
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cost_usd += estimate_cost(model, prompt_tokens, completion_tokens)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "parent": self.parent,
+            "start": self.start,
+            "seconds": round(self.seconds, 6) if self.seconds is not None else None,
+            "rss_delta_bytes": self.rss_delta_bytes,
+            "peak_alloc_bytes": self.peak_alloc_bytes,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost_usd": round(self.cost_usd, 6),
+            **self.attrs,
+        }
+
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.spans = []
+
+    def totals(self):
+        # Only leaf spans carry tokens, so summing every span never double counts
+        top_level = [s for s in self.spans if s.parent is None]
+        return {
+            "seconds": round(sum(s.seconds for s in top_level), 3),
+            "prompt_tokens": sum(s.prompt_tokens for s in self.spans),
+            "completion_tokens": sum(s.completion_tokens for s in self.spans),
+            "cost_usd": round(sum(s.cost_usd for s in self.spans), 6),
+            "peak_alloc_bytes": max((s.peak_alloc_bytes for s in self.spans if s.peak_alloc_bytes is not None),
+                                    default=None),
+        }
+
+    def to_jsonl(self):
+        return "".join(
+            json.dumps({"trace_id": self.trace_id, "trace": self.name, **s.to_dict()}) + "\n" for s in self.spans
+        )
+
+    def write_jsonl(self, path):
+        with open(path, "a") as f:
+            f.write(self.to_jsonl())
+
+
+class Metrics:
+    # Process-wide aggregates of every span, for the Prometheus endpoint
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def observe(self, span):
+        with self._lock:
+            stage = self._stages.setdefault(
+                span.name, {"count": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+            )
+            stage["count"] += 1
+            stage["seconds"] += span.seconds
+            stage["prompt_tokens"] += span.prompt_tokens
+            stage["completion_tokens"] += span.completion_tokens
+            stage["cost_usd"] += span.cost_usd
+
+    def prometheus_text(self):
+        with self._lock:
+            stages = sorted(self._stages.items())
+        lines = [
+            "# HELP cod_stage_seconds Wall time spent in each CoD pipeline stage.",
+            "# TYPE cod_stage_seconds summary",
+        ]
+        for name, stage in stages:
+            lines.append(f'cod_stage_seconds_sum{{stage="{name}"}} {stage["seconds"]:.6f}')
+            lines.append(f'cod_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+        lines += ["# HELP cod_tokens_total LLM tokens used per stage.", "# TYPE cod_tokens_total counter"]
+        for name, stage in stages:
+            if stage["prompt_tokens"] or stage["completion_tokens"]:
+                lines.append(f'cod_tokens_total{{stage="{name}",kind="prompt"}} {stage["prompt_tokens"]}')
+                lines.append(f'cod_tokens_total{{stage="{name}",kind="completion"}} {stage["completion_tokens"]}')
+        lines += ["# HELP cod_cost_usd_total Estimated OpenAI cost per stage.", "# TYPE cod_cost_usd_total counter"]
+        for name, stage in stages:
+            if stage["cost_usd"]:
+                lines.append(f'cod_cost_usd_total{{stage="{name}"}} {stage["cost_usd"]:.6f}')
+        lines += [
+            "# HELP cod_process_peak_rss_bytes Peak resident memory of this process.",
+            "# TYPE cod_process_peak_rss_bytes gauge",
+            f"cod_process_peak_rss_bytes {process_peak_rss_bytes()}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+@contextmanager
+def start_trace(name):
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        if TRACE_LOG:
+            trace.write_jsonl(TRACE_LOG)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name, **attrs):
+    # Spans nest; each one lands in the active trace (if any) and in METRICS
+    parent = _current_span.get()
+    current = Span(name, parent.name if parent is not None else None, attrs)
+    token = _current_span.set(current)
+    tracing_allocs = tracemalloc.is_tracing()
+    if tracing_allocs:
+        # The peak counter is global: each span resets it on entry and hands its own peak
+        # to its parent on exit. Spans running in other threads at the same time blur this.
+        alloc_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    rss_start = rss_bytes()
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        current.seconds = time.perf_counter() - start
+        rss_end = rss_bytes()
+        if rss_start is not None and rss_end is not None:
+            current.rss_delta_bytes = rss_end - rss_start
+        if tracing_allocs and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], current._child_peak)
+            current.peak_alloc_bytes = max(peak - alloc_start, 0)
+            if parent is not None:
+                parent._child_peak = max(parent._child_peak, peak)
+        _current_span.reset(token)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append(current)
+        METRICS.observe(current)
+
+
+def record_usage(response, model=None):
+    # Attributes an OpenAI response's token usage to the innermost open span
+    current = _current_span.get()
+    usage = response.get("usage") if response is not None else None
+    if current is None or not usage:
+        return
+    current.add_usage(model or response.get("model"), usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+
+
+def render_sidebar(trace):
+    import streamlit as st
+
+    totals = trace.totals()
+    st.sidebar.subheader("Run trace")
+    st.sidebar.metric("Wall time", f"{totals['seconds']} s")
+    st.sidebar.metric("Tokens", f"{totals['prompt_tokens']} + {totals['completion_tokens']}")
+    st.sidebar.metric("Estimated cost", f"${totals['cost_usd']:.4f}")
+    st.sidebar.dataframe(
+        [
+            {
+                "stage": s.name if s.parent is None else f"{s.parent} / {s.name}",
+                "seconds": round(s.seconds, 3),
+                "tokens": s.prompt_tokens + s.completion_tokens,
+                "cost_usd": round(s.cost_usd, 4),
+                "rss_delta_mb": None if s.rss_delta_bytes is None else round(s.rss_delta_bytes / 1024 ** 2, 1),
+                "peak_alloc_mb": None if s.peak_alloc_bytes is None else round(s.peak_alloc_bytes / 1024 ** 2, 1),
+            }
+            for s in sorted(trace.spans, key=lambda s: s.start)
+        ],
+        hide_index=True,
+    )
+    st.sidebar.download_button("Trace (JSON lines)", trace.to_jsonl(), file_name=f"trace-{trace.trace_id}.jsonl")
+    st.sidebar.download_button("Metrics (Prometheus)", METRICS.prometheus_text(), file_name="metrics.prom")
@@ -0,0 +1,125 @@
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.vectorstores.base import VectorStore
+
+MMR_FETCH_K = 20
+MMR_LAMBDA = 0.5
+
+
+def _unit_rows(vectors):
+    # Rows scaled to length 1, so a dot product is the cosine similarity
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores, k):
+    # Unordered partition first, then sort only the k winners
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def mmr(query_vector, candidates, k, lambda_mult=MMR_LAMBDA):
+    # Maximal marginal relevance over unit rows; returns positions into candidates
+    relevance = candidates @ query_vector
+    pairwise = candidates @ candidates.T
+    k = min(k, len(candidates))
+    selected = []
+    # Highest similarity to anything already picked, per candidate
+    redundancy = np.zeros(len(candidates), dtype=np.float32)
+    for step in range(k):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        redundancy = pairwise[best] if step == 0 else np.maximum(redundancy, pairwise[best])
+    return selected
+
+
+class NumpyVectorStore(VectorStore):
+    # All chunks of one document in a single float32 matrix; search is one matrix product.
+    # Meant for a few thousand chunks, above that index_store falls back to Chroma.
+
+    def __init__(self, embedding):
+        self.embedding = embedding
+        self.texts = []
+        self.metadatas = []
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        texts = list(texts)
+        if not texts:
+            return []
+        return self.add_vectors(texts, self.embedding.embed_documents(texts), metadatas)
+
+    def add_vectors(self, texts, vectors, metadatas=None):
+        # For texts whose embeddings are already at hand
+        rows = _unit_rows(vectors)
+        first = len(self.texts)
+        self.matrix = rows if first == 0 else np.concatenate([self.matrix, rows])
+        self.texts.extend(texts)
+        self.metadatas.extend(metadatas or [{} for _ in texts])
+        return [str(i) for i in range(first, len(self.texts))]
+
+    def _document(self, i):
+        return Document(page_content=self.texts[i], metadata=self.metadatas[i])
+
+    def _query_vectors(self, queries):
+        # One embedding request for every query
+        return _unit_rows(self.embedding.embed_documents(list(queries)))
+
+    def similarity_search_by_vector_with_scores(self, embedding, k=4):
+        if not self.texts:
+            return []
+        scores = self.matrix @ _unit_rows(embedding)[0]
+        return [(self._document(i), float(scores[i])) for i in _top_k(scores, k)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_scores(self._query_vectors([query])[0], k)
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_scores(embedding, k)]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def _similarity_search_with_relevance_scores(self, query, k=4, **kwargs):
+        # Cosine in [-1, 1] mapped onto [0, 1]
+        return [(doc, (score + 1) / 2) for doc, score in self.similarity_search_with_score(query, k)]
+
+    def batch_search(self, queries, k=4):
+        # Several queries in one embedding call and one matrix product; a list of results per query
+        if not self.texts or not queries:
+            return [[] for _ in queries]
+        scores = self._query_vectors(queries) @ self.matrix.T
+        return [[self._document(i) for i in _top_k(row, k)] for row in scores]
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=MMR_FETCH_K, lambda_mult=MMR_LAMBDA,
+                                                **kwargs):
+        if not self.texts:
+            return []
+        query_vector = _unit_rows(embedding)[0]
+        candidates = _top_k(self.matrix @ query_vector, fetch_k)
+        picked = mmr(query_vector, self.matrix[candidates], k, lambda_mult)
+        return [self._document(candidates[i]) for i in picked]
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=MMR_FETCH_K, lambda_mult=MMR_LAMBDA, **kwargs):
+        return self.max_marginal_relevance_search_by_vector(self._query_vectors([query])[0], k, fetch_k, lambda_mult)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        store = cls(embedding)
+        store.add_texts(texts, metadatas)
+        return store